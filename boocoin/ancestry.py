@@ -0,0 +1,49 @@
+def invert_lowest_one(n):
+    """
+    Returns n with its lowest set bit cleared.
+    """
+    return n & (n - 1)
+
+
+def get_skip_depth(depth):
+    """
+    Returns the depth of the ancestor that a block at the given depth keeps a
+    skip pointer to. Following skip pointers (and falling back to previous
+    blocks) reaches any ancestor in O(log n) steps, using the same scheme as
+    Bitcoin's block index.
+    """
+    if depth < 2:
+        return 0
+
+    # Odd depths skip a little less far back than even ones, which keeps
+    # walks between arbitrary depths short
+    if depth & 1:
+        return invert_lowest_one(invert_lowest_one(depth - 1)) + 1
+    return invert_lowest_one(depth)
+
+
+def find_ancestor(block_id, depth, target_depth, get_pointers):
+    """
+    Walks back from a block at the given depth to its ancestor at the target
+    depth, and returns the ancestor's id. get_pointers is called with a block
+    id and must return that block's (previous_block_id, skip_block_id).
+    """
+    while depth > target_depth:
+        previous_block_id, skip_block_id = get_pointers(block_id)
+        skip_depth = get_skip_depth(depth)
+        previous_skip_depth = get_skip_depth(depth - 1)
+
+        # Only follow the skip pointer if it doesn't overshoot the target, and
+        # the previous block's skip pointer wouldn't get us there faster
+        if skip_block_id and (
+            skip_depth == target_depth or (
+                skip_depth > target_depth and not (
+                    previous_skip_depth < skip_depth - 2 and
+                    previous_skip_depth >= target_depth
+                )
+            )
+        ):
+            block_id, depth = skip_block_id, skip_depth
+        else:
+            block_id, depth = previous_block_id, depth - 1
+    return block_id
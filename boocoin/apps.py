@@ -2,6 +2,7 @@ import logging
 import sys
 
 from django.apps import AppConfig
+from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
@@ -12,10 +13,28 @@ class BoocoinConfig(AppConfig):
     name = 'boocoin'
 
     def ready(self):
+        from django.db.backends.signals import connection_created
+        from boocoin.util.db import configure_connection
+        connection_created.connect(configure_connection)
+
         if RUNNING_SERVER:
-            from boocoin.models import SyncLock
+            from boocoin.mempool import get_mempool
+            from boocoin.models import Block, SyncLock
             from boocoin.p2p import sync_all
+            from boocoin.signing import (
+                precompute_keys, start_verification_pool
+            )
             from boocoin.timer import start_waiting_for_blocks
+            precompute_keys(
+                Block.get_authorized_miners() +
+                settings.PRECOMPUTED_PUBLIC_KEYS
+            )
+            if settings.SIGNATURE_VERIFICATION_WORKERS > 1:
+                start_verification_pool()
             SyncLock.objects.all().delete()
+            get_mempool().load()
+            if settings.PRUNE_KEEP_BLOCKS is not None:
+                from boocoin.pruning import start_pruning
+                start_pruning()
             start_waiting_for_blocks()
             sync_all()
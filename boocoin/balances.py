@@ -5,32 +5,99 @@ class InsufficientFunds(ValueError):
     pass
 
 
-def apply_transaction_to_balances(transaction, balances):
+class BalanceOverlay:
     """
-    Accepts a dictionary of balances and applies a transaction to it.
-    Returns the new dictionary of balances.
+    A mutable view over a dictionary of balances that only records the
+    accounts that change. Transactions are applied to the overlay one at a
+    time, and can then be committed or rolled back. The underlying balances
+    are never copied or modified.
+
+    Attributes:
+        balances (dict): The balances the overlay sits on top of.
+        changes (dict): The committed balances of every changed account.
+        pending (dict): Balances changed by the transaction that has been
+            applied but not yet committed or rolled back.
+    """
+
+    def __init__(self, balances):
+        self.balances = balances
+        self.changes = {}
+        self.pending = {}
+
+    def get(self, account, default=None):
+        """
+        Returns the balance of an account, including any pending changes.
+        """
+        if account in self.pending:
+            return self.pending[account]
+        if account in self.changes:
+            return self.changes[account]
+        return self.balances.get(account, default)
+
+    def apply(self, transaction):
+        """
+        Applies a transaction to the overlay. The transaction's changes remain
+        pending until commit() or rollback() is called.
+
+        Raises:
+            InsufficientFunds: If the account does not have enough coins. The
+                transaction is rolled back before this is raised.
+        """
+        try:
+            check_funds(transaction, self)
+        except InsufficientFunds:
+            self.rollback()
+            raise
+
+        # Remove the coins from the sender
+        if transaction.from_account:
+            self.pending[transaction.from_account] = self.get(
+                transaction.from_account
+            ) - transaction.coins
+
+        # Add the coins to the destination account
+        existing_balance = self.get(transaction.to_account, Decimal(0))
+        self.pending[transaction.to_account] = (
+            existing_balance + transaction.coins
+        )
+
+    def commit(self):
+        """
+        Commits the pending transaction's changes.
+        """
+        self.changes.update(self.pending)
+        self.pending = {}
+
+    def rollback(self):
+        """
+        Discards the pending transaction's changes.
+        """
+        self.pending = {}
+
+
+def check_funds(transaction, balances):
+    """
+    Ensures the sender of a transaction has the coins that they're
+    transferring. Block rewards (which have no sender) always pass.
 
     Raises:
         InsufficientFunds: If the account does not have enough coins.
     """
-    # Prevent modifying the passed balances object
-    balances = balances.copy()
-
-    # Ensure the user has the coins that they're transferring
     if transaction.from_account:
         from_balance = balances.get(transaction.from_account, Decimal(0))
         if from_balance < transaction.coins:
             raise InsufficientFunds(f'{from_balance} < {transaction.coins}')
 
-        # Remove the coins from the sender
-        balances[transaction.from_account] = from_balance - transaction.coins
 
-    # Add the coins to the destination account
-    existing_balance = balances.get(transaction.to_account, Decimal(0))
-    balances[transaction.to_account] = existing_balance + transaction.coins
+def apply_transaction_to_balances(transaction, balances):
+    """
+    Accepts a dictionary of balances and applies a transaction to it.
+    Returns the new dictionary of balances.
 
-    # Return the new balances
-    return balances
+    Raises:
+        InsufficientFunds: If the account does not have enough coins.
+    """
+    return apply_transactions_to_balances([transaction], balances)
 
 
 def apply_transactions_to_balances(transactions, balances):
@@ -41,6 +108,36 @@ def apply_transactions_to_balances(transactions, balances):
     Raises:
         InsufficientFunds: If one of the accounts does not have enough coins.
     """
-    for transaction in transactions:
-        balances = apply_transaction_to_balances(transaction, balances)
+    changes = get_balance_changes(transactions, balances)
+
+    # Prevent modifying the passed balances object
+    balances = balances.copy()
+    balances.update(changes)
     return balances
+
+
+def get_balance_changes(transactions, balances):
+    """
+    Accepts a dictionary of balances and plays a list of transactions over it.
+    Returns a dictionary of only the balances that changed.
+
+    Raises:
+        InsufficientFunds: If one of the accounts does not have enough coins.
+    """
+    overlay = BalanceOverlay(balances)
+    for transaction in transactions:
+        overlay.apply(transaction)
+        overlay.commit()
+    return overlay.changes
+
+
+def get_transaction_accounts(transactions):
+    """
+    Returns the set of accounts that a list of transactions touches.
+    """
+    accounts = set()
+    for transaction in transactions:
+        if transaction.from_account:
+            accounts.add(transaction.from_account)
+        accounts.add(transaction.to_account)
+    return accounts
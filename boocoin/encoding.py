@@ -0,0 +1,154 @@
+"""
+Serializes blocks and transactions into the canonical bytes that their hashes
+are calculated from.
+
+Version 0 is the original encoding: an ordered JSON object with extra_data
+hex encoded. Blocks mined before balance changes were stored are hashed with
+their complete balances JSON (see Block.legacy_balances), exactly as they
+were originally, while later blocks are hashed with their balances root in
+its place. Version 1 is a compact binary encoding that starts with the
+version number, followed by each field in a fixed order:
+
+    integers: fixed width and big endian (depth is an unsigned 64-bit integer,
+        time is a signed 64-bit count of microseconds since the Unix epoch,
+        and coins is a signed 128-bit count of hundred-millionths of a coin)
+    strings and bytes: a flag byte (0 for None, 1 otherwise), followed by the
+        length as an unsigned 32-bit integer and the raw (UTF-8) bytes
+
+Every node must hash with the same version, so it is declared by the genesis
+block (see Block.get_encoding_version).
+"""
+import simplejson as json
+import struct
+from binascii import hexlify
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+# The version used by new genesis blocks
+ENCODING_VERSION = 1
+
+COIN_PLACES = 8
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+MICROSECOND = timedelta(microseconds=1)
+
+NONE = b'\x00'
+
+PRESENT = b'\x01'
+
+
+def encode_bytes(value):
+    """
+    Returns the length prefixed encoding of bytes (or None).
+    """
+    if value is None:
+        return NONE
+    value = bytes(value)
+    return PRESENT + struct.pack('>I', len(value)) + value
+
+
+def encode_string(value):
+    """
+    Returns the length prefixed encoding of a string (or None).
+    """
+    if value is None:
+        return NONE
+    return encode_bytes(value.encode('utf-8'))
+
+
+def encode_time(value):
+    """
+    Returns the encoding of an aware datetime, in microseconds since the Unix
+    epoch.
+    """
+    return struct.pack('>q', (value - EPOCH) // MICROSECOND)
+
+
+def encode_coins(value):
+    """
+    Returns the encoding of a number of coins, in hundred-millionths of a
+    coin. Any further decimal places are truncated.
+    """
+    return int(Decimal(value).scaleb(COIN_PLACES)).to_bytes(
+        16,
+        'big',
+        signed=True,
+    )
+
+
+def encode_block(block, version=ENCODING_VERSION):
+    """
+    Returns the bytes that are hashed to calculate the block's hash.
+    """
+    if version == 0:
+        return encode_block_json(block)
+
+    return b''.join([
+        bytes([version]),
+        encode_string(block.previous_block_id),
+        struct.pack('>Q', block.depth),
+        encode_string(block.miner),
+        encode_string(block.balances_root),
+        encode_string(block.merkle_root),
+        encode_bytes(block.extra_data or None),
+        encode_time(block.time),
+    ])
+
+
+def encode_transaction(transaction, version=ENCODING_VERSION):
+    """
+    Returns the bytes that are hashed to calculate the transaction's hash.
+    """
+    if version == 0:
+        return encode_transaction_json(transaction)
+
+    return b''.join([
+        bytes([version]),
+        encode_string(transaction.from_account),
+        encode_string(transaction.to_account),
+        encode_coins(transaction.coins),
+        encode_bytes(transaction.extra_data or None),
+        encode_time(transaction.time),
+    ])
+
+
+def encode_block_json(block):
+    """
+    Returns the version 0 (JSON) encoding of a block.
+    """
+    extra_data = None
+    if block.extra_data:
+        extra_data = hexlify(block.extra_data).decode('utf-8')
+
+    balances = ('balances_root', block.balances_root)
+    if block.legacy_balances is not None:
+        balances = ('balances', block.legacy_balances)
+
+    return json.dumps(OrderedDict([
+        ('previous_block', block.previous_block_id),
+        ('depth', block.depth),
+        ('miner', block.miner),
+        balances,
+        ('merkle_root', block.merkle_root),
+        ('extra_data', extra_data),
+        ('time', block.time),
+    ]), default=str).encode('utf-8')
+
+
+def encode_transaction_json(transaction):
+    """
+    Returns the version 0 (JSON) encoding of a transaction.
+    """
+    extra_data = None
+    if transaction.extra_data:
+        extra_data = hexlify(transaction.extra_data).decode('utf-8')
+
+    return json.dumps(OrderedDict([
+        ('from_account', transaction.from_account),
+        ('to_account', transaction.to_account),
+        ('coins', transaction.coins),
+        ('extra_data', extra_data),
+        ('time', transaction.time),
+    ]), default=str).encode('utf-8')
@@ -4,14 +4,15 @@ from base64 import b64decode
 from django.utils.timezone import now
 from rest_framework import serializers
 
-from boocoin.mining import mine_block
+from boocoin.mining import is_transaction_threshold_met, request_mining
+from boocoin.mempool import get_mempool
 from boocoin.models import Block, UnconfirmedTransaction
 from boocoin.p2p import broadcast_transaction
 from boocoin.serializers import (
     TransactionSerializer, UnconfirmedTransactionSerializer
 )
 from boocoin.signing import (
-    SigningKey, VerifyingKey, key_to_hex, unhex, sign, verify
+    SigningKey, hex_to_pk, key_to_hex, sign, verify
 )
 from boocoin.validation import validate_transaction
 
@@ -19,16 +20,25 @@ logger = logging.getLogger(__name__)
 
 
 class TransactionForm(UnconfirmedTransactionSerializer):
+    class Meta(UnconfirmedTransactionSerializer.Meta):
+        # Duplicates are checked against the pool instead of the database
+        extra_kwargs = {'hash': {'validators': []}}
+
+    def validate_hash(self, hash):
+        if hash in get_mempool():
+            raise serializers.ValidationError('Transaction already submitted.')
+        return hash
+
     def validate_from_account(self, key):
         try:
-            VerifyingKey.from_string(unhex(key))
+            hex_to_pk(key)
         except Exception:
             raise serializers.ValidationError('Invalid public key.')
         return key
 
     def validate_to_account(self, key):
         try:
-            VerifyingKey.from_string(unhex(key))
+            hex_to_pk(key)
         except Exception:
             raise serializers.ValidationError('Invalid public key.')
         return key
@@ -58,10 +68,13 @@ class TransactionForm(UnconfirmedTransactionSerializer):
 
         data['transaction'] = tx
 
-        # Validate the transaction
+        # Validate the transaction against what the sender has left to spend
         active_block = Block.get_active_block()
         if not validate_transaction(
-            active_block.get_balances(),
+            get_mempool().get_available_balances(
+                [tx.from_account],
+                active_block,
+            ),
             tx,
             prev_block=active_block,
         ):
@@ -71,15 +84,18 @@ class TransactionForm(UnconfirmedTransactionSerializer):
 
     def save(self):
         self.transaction = self.validated_data['transaction']
-        self.transaction.save()
-
-        # Mine a block if we have at least 10 transaction waiting
-        if UnconfirmedTransaction.objects.count() >= 10:
-            logger.info('At least 10 transactions waiting, mining new block.')
-            mine_block()
-        else:
-            # Notify other nodes about the transaction
-            broadcast_transaction(self.transaction)
+        mempool = get_mempool()
+        if not mempool.add(self.transaction, Block.get_active_block()):
+            raise serializers.ValidationError('Transaction was not accepted.')
+
+        # Notify other nodes about the transaction (even if it triggers a new
+        # block, since mining happens in the background)
+        broadcast_transaction(self.transaction)
+
+        # Mine a block if enough transactions are waiting
+        if is_transaction_threshold_met():
+            logger.info('Enough transactions waiting, mining new block.')
+            request_mining()
 
     def to_representation(self, instance):
         self.transaction.block = None
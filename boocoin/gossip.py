@@ -0,0 +1,138 @@
+import logging
+import queue
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+peers = {}
+peers_lock = threading.Lock()
+
+
+class Peer:
+    """
+    Sends messages to a single node in the background. Messages are queued
+    and posted in order by a dedicated thread, over a keep-alive session.
+
+    Attributes:
+        node: The URL of the node.
+        session: The requests session used for every message to the node.
+        queue: Outbound messages, as (path, data, batch_key, callback)
+            tuples. When the queue is full, new messages are dropped rather
+            than blocking the sender.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.session = requests.Session()
+        self.queue = queue.Queue(maxsize=settings.GOSSIP_QUEUE_SIZE)
+
+        t = threading.Thread(target=self.run)
+        t.setDaemon(True)
+        t.start()
+
+    def send(self, path, data, batch_key=None, callback=None):
+        """
+        Queues a message to be posted to the node. If a batch_key is given,
+        consecutive messages to the same path are coalesced and posted
+        together as {batch_key: [data, ...]}.
+
+        If a callback is given, it is called with the peer and the node's
+        response once the message has been sent. It runs on the peer's
+        thread, so any follow-up messages it posts are sent in order.
+        """
+        try:
+            self.queue.put_nowait((path, data, batch_key, callback))
+        except queue.Full:
+            logger.warn(f'Outbound queue for {self.node} is full, dropping '
+                        f'message to {path}.')
+
+    def run(self):
+        message = None
+        while True:
+            path, data, batch_key, callback = message or self.queue.get()
+            message = None
+
+            # Callbacks may query the database
+            close_old_connections()
+            if batch_key:
+                data, message = self.collect(path, data, batch_key)
+            try:
+                response = self.post(path, data)
+                if callback and response is not None:
+                    callback(self, response)
+            except Exception as e:
+                logger.warn(str(e))
+
+    def collect(self, path, data, batch_key):
+        """
+        Waits up to GOSSIP_BATCH_WINDOW seconds for more messages to the same
+        path, and combines them into a single batch. Returns the batch, along
+        with the message that interrupted it (if any), which should be sent
+        next so that ordering is preserved.
+        """
+        items = [data]
+        deadline = time.monotonic() + settings.GOSSIP_BATCH_WINDOW
+        while len(items) < settings.GOSSIP_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                message = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if message[0] != path or message[2] != batch_key:
+                return {batch_key: items}, message
+            items.append(message[1])
+        return {batch_key: items}, None
+
+    def post(self, path, data):
+        """
+        Posts a message to the node, retrying with exponential backoff if the
+        node can't be reached or has an error. Rejected messages (any 4xx
+        response) are not retried. Returns the response, or None if the
+        message could not be delivered.
+        """
+        delay = settings.GOSSIP_RETRY_DELAY
+        for attempt in range(settings.GOSSIP_RETRIES + 1):
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+
+            try:
+                response = self.session.post(
+                    f'{self.node}{path}',
+                    json=data,
+                    timeout=settings.GOSSIP_TIMEOUT,
+                )
+            except requests.RequestException as e:
+                error = str(e)
+            else:
+                if response.status_code < 500:
+                    return response
+                error = f'{response.status_code} response'
+
+        logger.warn(f'Failed to send message to {self.node}{path}: {error}')
+
+
+def get_peer(node):
+    """
+    Returns the Peer for the given node, creating it if needed.
+    """
+    with peers_lock:
+        if node not in peers:
+            peers[node] = Peer(node)
+        return peers[node]
+
+
+def broadcast(nodes, path, data, batch_key=None, callback=None):
+    """
+    Queues a message to be posted to each of the nodes. This returns
+    immediately; the messages are sent concurrently in the background.
+    """
+    for node in nodes:
+        get_peer(node).send(path, data, batch_key, callback)
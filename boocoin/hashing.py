@@ -1,20 +1,191 @@
 from binascii import hexlify
 import hashlib
 
-from merkletools import MerkleTools
+# Balances are committed to with a multiplicative set hash (MuHash): every
+# account's balance is hashed to a number modulo a 3072-bit prime, and the
+# balances hash is the product of those numbers. This lets a block's balances
+# hash be derived from its parent's by swapping out only the accounts that
+# changed. The balances root is the SHA3-256 hash of the balances hash.
+BALANCES_HASH_PRIME = 2 ** 3072 - 1103717
+
+BALANCES_HASH_SIZE = 384
+
+EMPTY_BALANCES_HASH = (1).to_bytes(BALANCES_HASH_SIZE, 'big')
+
+# The size of each node's digest in a merkle tree
+MERKLE_NODE_SIZE = 32
 
 
 def create_hash(content):
+    if isinstance(content, str):
+        content = content.encode('utf-8')
     hasher = hashlib.sha3_256()
-    hasher.update(content.encode('utf-8'))
+    hasher.update(content)
     return hexlify(hasher.digest()).decode('utf-8')
 
 
-def calculate_merkle_root(hashes):
-    mt = MerkleTools(hash_type='sha3_256')
+def hash_pair(left, right):
+    """
+    Returns the digest of two concatenated merkle tree nodes.
+    """
+    return hashlib.sha3_256(left + right).digest()
+
+
+class MerkleRootBuilder:
+    """
+    Calculates a merkle root from a stream of hex leaves, only keeping the
+    root of each complete subtree seen so far (so O(log n) digests).
+
+    When a level of the tree has an odd number of nodes, the last node is
+    promoted to the next level as-is, rather than being paired with a copy
+    of itself.
+
+    Attributes:
+        subtrees (list): (height, digest) tuples for the complete subtrees,
+            tallest first.
+    """
 
+    def __init__(self):
+        self.subtrees = []
+
+    def add(self, leaf):
+        """
+        Adds a leaf (a hex digest) to the tree.
+        """
+        height = 0
+        digest = bytes.fromhex(leaf)
+        while self.subtrees and self.subtrees[-1][0] == height:
+            digest = hash_pair(self.subtrees.pop()[1], digest)
+            height += 1
+        self.subtrees.append((height, digest))
+
+    def get_root(self):
+        """
+        Returns the merkle root of the leaves added so far, or None if there
+        aren't any. Promoting odd nodes means the smaller subtrees on the
+        right are combined first, and then joined to the taller ones.
+        """
+        if not self.subtrees:
+            return None
+        root = self.subtrees[-1][1]
+        for height, digest in reversed(self.subtrees[:-1]):
+            root = hash_pair(digest, root)
+        return hexlify(root).decode('utf-8')
+
+
+def calculate_merkle_root(hashes):
+    builder = MerkleRootBuilder()
     for h in hashes:
-        mt.add_leaf(h)
+        builder.add(h)
+    return builder.get_root()
+
+
+def build_merkle_tree(hashes):
+    """
+    Builds a complete merkle tree. Returns a list of levels, starting with the
+    leaves and ending with the root, where each level is a list of digests.
+    """
+    levels = [[bytes.fromhex(h) for h in hashes]]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        next_level = [
+            hash_pair(level[i], level[i + 1])
+            for i in range(0, len(level) - 1, 2)
+        ]
+        if len(level) % 2:
+            next_level.append(level[-1])
+        levels.append(next_level)
+    return levels
+
+
+def get_merkle_proof(levels, index):
+    """
+    Returns the proof that the leaf at the given index is in a merkle tree
+    (see build_merkle_tree). The proof is a list of the sibling nodes needed
+    to work up to the root, as {'left': hex} or {'right': hex} dictionaries.
+    """
+    proof = []
+    for level in levels[:-1]:
+        if index % 2:
+            proof.append({'left': hexlify(level[index - 1]).decode('utf-8')})
+        elif index + 1 < len(level):
+            proof.append({'right': hexlify(level[index + 1]).decode('utf-8')})
+        index //= 2
+    return proof
+
+
+def verify_merkle_proof(proof, leaf, merkle_root):
+    """
+    Returns whether or not the proof shows that the leaf (a hex digest) is in
+    the tree with the given merkle root.
+    """
+    digest = bytes.fromhex(leaf)
+    for node in proof:
+        if 'left' in node:
+            digest = hash_pair(bytes.fromhex(node['left']), digest)
+        else:
+            digest = hash_pair(digest, bytes.fromhex(node['right']))
+    return hexlify(digest).decode('utf-8') == merkle_root
+
+
+def hash_balance(account, balance):
+    """
+    Returns the hash of a single account balance as a number modulo
+    BALANCES_HASH_PRIME.
+    """
+    hasher = hashlib.shake_256(f'{account}:{balance:.8f}'.encode('utf-8'))
+    value = int.from_bytes(hasher.digest(BALANCES_HASH_SIZE), 'big')
+    return value % BALANCES_HASH_PRIME
+
+
+def invert_modulo(value, modulus):
+    """
+    Returns the modular multiplicative inverse of value, using the extended
+    Euclidean algorithm (which is much faster than Fermat's little theorem
+    for numbers this size).
+    """
+    a, b = value, modulus
+    x, last_x = 0, 1
+    while b:
+        quotient, remainder = divmod(a, b)
+        a, b = b, remainder
+        x, last_x = last_x - quotient * x, x
+    return last_x % modulus
+
+
+def calculate_balances_hash(balances):
+    """
+    Calculates the balances hash for a complete dictionary of balances.
+    """
+    return update_balances_hash(EMPTY_BALANCES_HASH, {}, balances)
+
+
+def update_balances_hash(balances_hash, previous_balances, balances):
+    """
+    Returns a new balances hash after applying changed balances to an
+    existing one. previous_balances must contain the previous balance of
+    every changed account that already existed.
+    """
+    # Multiply in the new balances and divide out the previous ones, with a
+    # single (slow) inversion at the end
+    numerator = int.from_bytes(balances_hash, 'big')
+    denominator = 1
+    for account, balance in balances.items():
+        previous_balance = previous_balances.get(account)
+        if previous_balance is not None:
+            denominator *= hash_balance(account, previous_balance)
+            denominator %= BALANCES_HASH_PRIME
+        numerator *= hash_balance(account, balance)
+        numerator %= BALANCES_HASH_PRIME
+
+    if denominator != 1:
+        numerator *= invert_modulo(denominator, BALANCES_HASH_PRIME)
+        numerator %= BALANCES_HASH_PRIME
+    return numerator.to_bytes(BALANCES_HASH_SIZE, 'big')
+
 
-    mt.make_tree()
-    return mt.get_merkle_root()
+def get_balances_root(balances_hash):
+    """
+    Returns the balances root that blocks store for a balances hash.
+    """
+    return create_hash(bytes(balances_hash))
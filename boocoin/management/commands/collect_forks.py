@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from boocoin.pruning import collect_forks
+
+
+class Command(BaseCommand):
+    help = 'Deletes blocks on forks that split off from the active chain long ago.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep',
+            type=int,
+            default=settings.FORK_KEEP_BLOCKS,
+            help=(
+                'Forks that split off within this many blocks of the active '
+                'block are kept.'
+            ),
+        )
+
+    def handle(self, *args, **options):
+        deleted = collect_forks(options['keep'])
+        self.stdout.write(f'Deleted {deleted} blocks from orphaned forks.\n')
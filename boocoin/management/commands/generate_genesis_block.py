@@ -4,9 +4,11 @@ import sys
 from django.core.management import call_command
 from django.core.management.base import BaseCommand
 from django.conf import settings
+from django.db import connections
 from django.utils.timezone import now
 
 from boocoin.balances import apply_transaction_to_balances
+from boocoin.encoding import ENCODING_VERSION
 from boocoin.models import Block, Transaction
 
 
@@ -29,19 +31,46 @@ class Command(BaseCommand):
             sys.stderr.write("Your public key must be included.\n")
             sys.exit(1)
 
+        # Blocks must be able to hold enough transactions to meet the
+        # threshold, along with the block reward (unless there's no limit)
+        if (
+            settings.MAX_BLOCK_TRANSACTIONS is not None and
+            settings.MAX_BLOCK_TRANSACTIONS <=
+            settings.BLOCK_TRANSACTION_THRESHOLD
+        ):
+            sys.stderr.write(
+                "MAX_BLOCK_TRANSACTIONS must be greater than "
+                "BLOCK_TRANSACTION_THRESHOLD.\n"
+            )
+            sys.exit(1)
+
         # Set up the first transaction
         transaction = Transaction.create_block_reward()
         transactions = [transaction]
 
+        # The genesis block declares the authorized miners and the rest of
+        # the consensus parameters
+        params = {
+            'miners': miners,
+            'block_interval': settings.BLOCK_INTERVAL,
+            'transaction_threshold': settings.BLOCK_TRANSACTION_THRESHOLD,
+            'max_block_transactions': settings.MAX_BLOCK_TRANSACTIONS,
+            'max_block_bytes': settings.MAX_BLOCK_BYTES,
+            'encoding_version': ENCODING_VERSION,
+        }
+
         # Set up the genesis block
         block = Block(
             depth=0,
             miner=settings.MINER_PUBLIC_KEY,
-            extra_data=json.dumps(miners).encode('utf-8'),
+            extra_data=json.dumps(params).encode('utf-8'),
             time=now(),
         )
         block.set_merkle_root(transactions)
-        block.set_balances(apply_transaction_to_balances(transaction, {}))
+        block.set_balance_changes(
+            {},
+            apply_transaction_to_balances(transaction, {}),
+        )
         block.set_hash()
         block.sign()
         block.save(transactions)
@@ -51,7 +80,15 @@ class Command(BaseCommand):
             'dumpdata',
             'boocoin.Block',
             'boocoin.Transaction',
+            'boocoin.BalanceChange',
+            'boocoin.BalanceCheckpoint',
+            'boocoin.TransactionIndex',
+            'boocoin.MerkleTree',
             indent=4,
             output='genesis.json'
         )
+
+        # Closing the connection moves everything out of SQLite's write-ahead
+        # log, so the database file can be copied to other miners
+        connections.close_all()
         self.stdout.write('Genesis block saved to db and genesis.json\n')
@@ -0,0 +1,37 @@
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from boocoin.pruning import prune_blocks
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes the transactions and balance data of old blocks, optionally '
+        'archiving them first.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep',
+            type=int,
+            default=settings.PRUNE_KEEP_BLOCKS,
+            help='The number of recent blocks to keep in full.',
+        )
+        parser.add_argument(
+            '--archive',
+            default=settings.ARCHIVE_DIR,
+            help='A directory to export the pruned data to.',
+        )
+
+    def handle(self, *args, **options):
+        if options['keep'] is None:
+            sys.stderr.write(
+                "Pass --keep or set PRUNE_KEEP_BLOCKS to choose how many "
+                "blocks to keep.\n"
+            )
+            sys.exit(1)
+
+        pruned = prune_blocks(options['keep'], archive_dir=options['archive'])
+        self.stdout.write(f'Pruned {pruned} blocks.\n')
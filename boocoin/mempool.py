@@ -0,0 +1,317 @@
+import bisect
+import logging
+import queue
+import threading
+from collections import defaultdict
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import (
+    IntegrityError, close_old_connections, transaction as db_transaction
+)
+from django.dispatch import receiver
+
+from boocoin.models import Transaction, UnconfirmedTransaction
+from boocoin.signals import tip_changed
+from boocoin.util.db import chunks, write_lock
+
+logger = logging.getLogger(__name__)
+
+mempool = None
+mempool_lock = threading.Lock()
+
+
+class Mempool:
+    """
+    The unconfirmed transactions waiting to be mined, kept in memory. They are
+    ordered by time (and then hash), and when the pool is full the newest
+    transactions are evicted first.
+
+    The pool keeps track of how many coins each account is spending in its
+    pending transactions. Combined with the account's balance as of the active
+    block (which is cached until the active block changes), new transactions
+    can be checked against everything the account has already spent.
+
+    Changes are written to the UnconfirmedTransaction table in the background,
+    purely so that the pool can be reloaded after a restart.
+
+    Attributes:
+        max_size (int): The most transactions the pool will hold.
+        transactions (dict): Unconfirmed transactions keyed by hash.
+        order (list): (time, hash) tuples for every transaction, sorted.
+        spending (dict): The total coins each account is sending in the pool.
+        balances (dict): Cached balances of accounts as of balances_block.
+        balances_block (str): The hash of the block the cached balances are
+            from.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.transactions = {}
+        self.order = []
+        self.spending = defaultdict(Decimal)
+        self.balances = {}
+        self.balances_block = None
+        self.lock = threading.RLock()
+        self.persist_queue = None
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.transactions
+
+    def get(self, tx_hash):
+        """
+        Returns the transaction with the given hash, or None.
+        """
+        return self.transactions.get(tx_hash)
+
+    def get_ordered(self):
+        """
+        Returns every transaction, oldest first.
+        """
+        with self.lock:
+            return [self.transactions[h] for t, h in self.order]
+
+    def get_confirmed_balances(self, accounts, active_block):
+        """
+        Returns the balance of each account as of the active block.
+        """
+        with self.lock:
+            if self.balances_block != active_block.id:
+                self.balances_block = active_block.id
+                self.balances = {}
+            balances = {
+                a: self.balances[a] for a in accounts if a in self.balances
+            }
+
+        # Look up any balances that aren't cached yet
+        missing = [a for a in accounts if a not in balances]
+        if missing:
+            loaded = active_block.get_balances(missing)
+            loaded = {a: loaded.get(a, Decimal(0)) for a in missing}
+            with self.lock:
+                if self.balances_block == active_block.id:
+                    self.balances.update(loaded)
+            balances.update(loaded)
+        return balances
+
+    def get_available_balances(self, accounts, active_block):
+        """
+        Returns the balance each account has available to spend, which is its
+        balance as of the active block, less the coins it is sending in the
+        pool.
+        """
+        balances = self.get_confirmed_balances(accounts, active_block)
+        with self.lock:
+            return {a: b - self.spending.get(a, 0) for a, b in balances.items()}
+
+    def add(self, transaction, active_block=None):
+        """
+        Adds a transaction to the pool. Returns whether or not it was added,
+        which it won't be if it is already in the pool, is malformed (see
+        add_many), is the newest transaction in a full pool, or (if the active
+        block is given) the sender can't afford it.
+        """
+        return bool(self.add_many([transaction], active_block))
+
+    def add_many(self, transactions, active_block=None):
+        """
+        Adds several transactions to the pool. Returns the ones that were
+        added. If the active block is given, transactions are only added if
+        their senders can afford them along with everything else they're
+        sending in the pool.
+
+        Transactions that don't send a positive number of coins, or whose
+        hash doesn't match their content, are never added. Otherwise they
+        could be used to inflate what their senders have left to spend.
+        """
+        transactions = [
+            t for t in transactions
+            if t.coins > 0 and t.hash == t.calculate_hash()
+        ]
+        if active_block:
+            balances = self.get_confirmed_balances(
+                {t.from_account for t in transactions},
+                active_block,
+            )
+
+        added = []
+        evicted = []
+        with self.lock:
+            for transaction in transactions:
+                if transaction.hash in self.transactions:
+                    continue
+
+                # Make sure the sender can afford it
+                sender = transaction.from_account
+                if active_block and transaction.coins > (
+                    balances[sender] - self.spending.get(sender, 0)
+                ):
+                    continue
+
+                # Make room by evicting the newest transaction, unless this
+                # one is newer still
+                key = (transaction.time, transaction.hash)
+                if len(self.transactions) >= self.max_size:
+                    if key > self.order[-1]:
+                        continue
+                    evicted.append(self._remove(self.order[-1][1]))
+
+                self._add(transaction)
+                bisect.insort(self.order, key)
+                added.append(transaction)
+
+            # Later transactions may have evicted ones added earlier on
+            added = [t for t in added if t.hash in self.transactions]
+            if evicted:
+                logger.debug(f'Evicted {len(evicted)} transactions')
+                self.persist('delete', [t.hash for t in evicted])
+            if added:
+                self.persist('create', added)
+        return added
+
+    def remove(self, tx_hashes):
+        """
+        Removes any transactions with the given hashes from the pool. Returns
+        the transactions that were removed.
+        """
+        with self.lock:
+            removed = [
+                self._remove(h) for h in tx_hashes if h in self.transactions
+            ]
+            if removed:
+                self.persist('delete', [t.hash for t in removed])
+        return removed
+
+    def _add(self, transaction):
+        self.transactions[transaction.hash] = transaction
+        self.spending[transaction.from_account] += transaction.coins
+
+    def _remove(self, tx_hash):
+        transaction = self.transactions.pop(tx_hash)
+        spending = self.spending[transaction.from_account] - transaction.coins
+        if spending:
+            self.spending[transaction.from_account] = spending
+        else:
+            del self.spending[transaction.from_account]
+        key = (transaction.time, transaction.hash)
+        del self.order[bisect.bisect_left(self.order, key)]
+        return transaction
+
+    def load(self):
+        """
+        Loads the transactions that were persisted before a restart.
+        """
+        transactions = list(
+            UnconfirmedTransaction.objects.order_by('time', 'hash')
+        )
+        with self.lock:
+            for transaction in transactions:
+                self._add(transaction)
+                self.order.append((transaction.time, transaction.hash))
+
+        # Trim the pool in case the maximum size has been lowered
+        if len(self.transactions) > self.max_size:
+            with self.lock:
+                overflow = [h for t, h in self.order[self.max_size:]]
+            self.remove(overflow)
+        logger.info(f'Loaded {len(self)} unconfirmed transactions.')
+
+    def persist(self, action, items):
+        """
+        Queues a change to be written to the UnconfirmedTransaction table.
+        Changes are queued while holding the lock, so they are written in the
+        same order they were made.
+        """
+        with self.lock:
+            if self.persist_queue is None:
+                self.persist_queue = queue.Queue()
+                t = threading.Thread(target=self.run_persistence)
+                t.setDaemon(True)
+                t.start()
+            self.persist_queue.put((action, items))
+
+    def run_persistence(self):
+        while True:
+            action, items = self.persist_queue.get()
+            close_old_connections()
+            try:
+                with write_lock:
+                    if action == 'create':
+                        save_transactions(items)
+                    else:
+                        delete_transactions(items)
+            except Exception as e:
+                logger.warn(f'Failed to persist unconfirmed transactions: {e}')
+
+
+def save_transactions(transactions):
+    try:
+        with db_transaction.atomic():
+            UnconfirmedTransaction.objects.bulk_create(transactions)
+    except IntegrityError:
+        # Some of them were already saved, so only create the rest
+        existing = set(UnconfirmedTransaction.objects.filter(
+            hash__in=[t.hash for t in transactions]
+        ).values_list('hash', flat=True))
+        UnconfirmedTransaction.objects.bulk_create(
+            t for t in transactions if t.hash not in existing
+        )
+
+
+def delete_transactions(tx_hashes):
+    for chunk in chunks(tx_hashes):
+        UnconfirmedTransaction.objects.filter(hash__in=chunk).delete()
+
+
+@receiver(tip_changed)
+def follow_chain_tip(sender, block, disconnected, connected, **kwargs):
+    """
+    Keeps the pool in step with the active chain. Transactions in blocks that
+    joined the chain are removed, and transactions in blocks that left it
+    are put back (unless the new branch includes them too, or the sender can
+    no longer afford them).
+    """
+    mempool = get_mempool()
+    confirmed = set()
+    for chunk in chunks(connected):
+        confirmed.update(Transaction.objects.filter(
+            block_id__in=chunk,
+        ).values_list('hash', flat=True))
+    mempool.remove(confirmed)
+
+    # Put the orphaned transactions back in the order they were mined
+    orphaned = []
+    for chunk in chunks(reversed(disconnected)):
+        positions = {block_id: i for i, block_id in enumerate(chunk)}
+        transactions = Transaction.objects.filter(
+            block_id__in=chunk,
+            from_account__isnull=False,
+        )
+        orphaned.extend(
+            t.to_unconfirmed_transaction()
+            for t in sorted(transactions, key=lambda t: (
+                positions[t.block_id], t.id
+            ))
+            if t.hash not in confirmed
+        )
+    if orphaned:
+        added = mempool.add_many(orphaned, block)
+        logger.info(
+            f'Returned {len(added)} of {len(orphaned)} orphaned transactions '
+            f'to the pool.'
+        )
+
+
+def get_mempool():
+    """
+    Returns the pool of unconfirmed transactions, creating it the first time
+    it is needed.
+    """
+    global mempool
+    with mempool_lock:
+        if mempool is None:
+            mempool = Mempool(settings.MEMPOOL_MAX_SIZE)
+        return mempool
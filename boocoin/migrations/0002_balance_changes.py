@@ -0,0 +1,120 @@
+from decimal import Decimal
+
+import simplejson as json
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+from boocoin.hashing import calculate_balances_hash, get_balances_root
+
+
+def parse_balances(block):
+    if not block:
+        return {}
+    balances = json.loads(block.balances, use_decimal=True)
+    return {a: Decimal(b) for a, b in balances.items()}
+
+
+def split_balances(apps, schema_editor):
+    """
+    Converts the full balances snapshot stored on each block into balance
+    changes, keeping a snapshot only for checkpoint blocks. The original JSON
+    string is kept in legacy_balances, since the block's hash covers it.
+    """
+    Block = apps.get_model('boocoin', 'Block')
+    BalanceChange = apps.get_model('boocoin', 'BalanceChange')
+    BalanceCheckpoint = apps.get_model('boocoin', 'BalanceCheckpoint')
+
+    for block in Block.objects.order_by('depth'):
+        balances = parse_balances(block)
+        previous_balances = parse_balances(block.previous_block)
+
+        BalanceChange.objects.bulk_create(
+            BalanceChange(
+                block=block,
+                account=account,
+                previous_balance=previous_balances.get(account),
+                balance=balance,
+            )
+            for account, balance in balances.items()
+            if previous_balances.get(account) != balance
+        )
+
+        # The original balances are part of the block's hash
+        block.legacy_balances = block.balances
+        block.balances_hash = calculate_balances_hash(balances)
+        block.balances_root = get_balances_root(block.balances_hash)
+        if block.depth % settings.BALANCE_CHECKPOINT_INTERVAL == 0:
+            BalanceCheckpoint.objects.bulk_create(
+                BalanceCheckpoint(block=block, account=a, balance=b)
+                for a, b in balances.items()
+            )
+            block.is_checkpoint = True
+        block.save(update_fields=[
+            'balances_root', 'balances_hash', 'legacy_balances',
+            'is_checkpoint',
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('boocoin', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='block',
+            name='balances_root',
+            field=models.CharField(default='', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='block',
+            name='balances_hash',
+            field=models.BinaryField(default=b''),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='block',
+            name='legacy_balances',
+            field=models.TextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='block',
+            name='is_checkpoint',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='BalanceChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account', models.CharField(db_index=True, max_length=96)),
+                ('previous_balance', models.DecimalField(decimal_places=8, max_digits=20, null=True)),
+                ('balance', models.DecimalField(decimal_places=8, max_digits=20)),
+                ('block', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_changes', to='boocoin.Block')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BalanceCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account', models.CharField(max_length=96)),
+                ('balance', models.DecimalField(decimal_places=8, max_digits=20)),
+                ('block', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_checkpoints', to='boocoin.Block')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='balancechange',
+            unique_together={('block', 'account')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='balancecheckpoint',
+            unique_together={('block', 'account')},
+        ),
+        migrations.RunPython(split_balances, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='block',
+            name='balances',
+        ),
+    ]
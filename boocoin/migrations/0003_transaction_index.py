@@ -0,0 +1,60 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+from boocoin.ancestry import find_ancestor, get_skip_depth
+
+
+def index_chain(apps, schema_editor):
+    """
+    Sets the skip pointer of every existing block and indexes the
+    transactions they contain.
+    """
+    Block = apps.get_model('boocoin', 'Block')
+    Transaction = apps.get_model('boocoin', 'Transaction')
+    TransactionIndex = apps.get_model('boocoin', 'TransactionIndex')
+
+    pointers = {}
+    for block in Block.objects.order_by('depth'):
+        if block.previous_block_id:
+            block.skip_block_id = find_ancestor(
+                block.previous_block_id,
+                block.depth - 1,
+                get_skip_depth(block.depth),
+                pointers.__getitem__,
+            )
+            block.save(update_fields=['skip_block'])
+        pointers[block.id] = (block.previous_block_id, block.skip_block_id)
+
+    TransactionIndex.objects.bulk_create(
+        TransactionIndex(hash=t.hash, block_id=t.block_id, depth=t.block.depth)
+        for t in Transaction.objects.select_related('block')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('boocoin', '0002_balance_changes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='block',
+            name='skip_block',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='boocoin.Block'),
+        ),
+        migrations.CreateModel(
+            name='TransactionIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(db_index=True, max_length=64)),
+                ('depth', models.IntegerField()),
+                ('block', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='transaction_index', to='boocoin.Block')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='transactionindex',
+            unique_together={('hash', 'block')},
+        ),
+        migrations.RunPython(index_chain, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def record_chain_tip(apps, schema_editor):
+    """
+    Records the active block of an existing chain as the chain tip.
+    """
+    Block = apps.get_model('boocoin', 'Block')
+    ChainTip = apps.get_model('boocoin', 'ChainTip')
+
+    block = Block.objects.order_by('-depth', 'id').first()
+    if block:
+        ChainTip.objects.create(pk=1, block=block, depth=block.depth)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('boocoin', '0003_transaction_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='block',
+            index=models.Index(fields=['-depth', 'id'], name='boocoin_block_tip_idx'),
+        ),
+        migrations.CreateModel(
+            name='ChainTip',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.IntegerField()),
+                ('block', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='boocoin.Block')),
+            ],
+        ),
+        migrations.RunPython(record_chain_tip, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+from boocoin.hashing import build_merkle_tree
+
+
+def build_merkle_trees(apps, schema_editor):
+    """
+    Builds and stores the merkle tree of every existing block.
+    """
+    Block = apps.get_model('boocoin', 'Block')
+    Transaction = apps.get_model('boocoin', 'Transaction')
+    MerkleTree = apps.get_model('boocoin', 'MerkleTree')
+
+    for block in Block.objects.all():
+        levels = build_merkle_tree(
+            Transaction.objects.filter(
+                block=block
+            ).order_by('id').values_list('hash', flat=True)
+        )
+        MerkleTree.objects.create(
+            block=block,
+            leaf_count=len(levels[0]),
+            nodes=b''.join(node for level in levels for node in level),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('boocoin', '0004_chain_tip'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MerkleTree',
+            fields=[
+                ('block', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='merkle_tree', serialize=False, to='boocoin.Block')),
+                ('leaf_count', models.IntegerField()),
+                ('nodes', models.BinaryField()),
+            ],
+        ),
+        migrations.RunPython(build_merkle_trees, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('boocoin', '0005_merkle_tree'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='transaction',
+            options={'ordering': ['id']},
+        ),
+        migrations.AddIndex(
+            model_name='unconfirmedtransaction',
+            index=models.Index(fields=['time', 'hash'], name='boocoin_unconfirmed_time_idx'),
+        ),
+    ]
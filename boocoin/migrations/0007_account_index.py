@@ -0,0 +1,89 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_account_index(apps, schema_editor):
+    """
+    Builds the balances and transaction history of every account in the
+    active chain.
+    """
+    Block = apps.get_model('boocoin', 'Block')
+    BalanceChange = apps.get_model('boocoin', 'BalanceChange')
+    ChainTip = apps.get_model('boocoin', 'ChainTip')
+    Transaction = apps.get_model('boocoin', 'Transaction')
+    AccountState = apps.get_model('boocoin', 'AccountState')
+    AccountTransaction = apps.get_model('boocoin', 'AccountTransaction')
+
+    tip = ChainTip.objects.filter(pk=1).first()
+    if not tip:
+        return
+
+    # Follow the active chain back from the tip
+    previous_blocks = dict(Block.objects.values_list('id', 'previous_block_id'))
+    chain = []
+    block_id = tip.block_id
+    while block_id:
+        chain.append(block_id)
+        block_id = previous_blocks[block_id]
+    chain.reverse()
+
+    balances = {}
+    for i in range(0, len(chain), 500):
+        chunk = chain[i:i + 500]
+        balances.update(BalanceChange.objects.filter(
+            block_id__in=chunk,
+        ).order_by('block__depth').values_list('account', 'balance'))
+
+        positions = {block_id: n for n, block_id in enumerate(chunk)}
+        transactions = sorted(
+            Transaction.objects.filter(block_id__in=chunk).values_list(
+                'id', 'block_id', 'from_account', 'to_account'
+            ),
+            key=lambda t: (positions[t[1]], t[0]),
+        )
+        AccountTransaction.objects.bulk_create(
+            AccountTransaction(
+                account=account,
+                transaction_id=tx_id,
+                block_id=block_id,
+            )
+            for tx_id, block_id, from_account, to_account in transactions
+            for account in (from_account, to_account)
+            if account
+        )
+
+    AccountState.objects.bulk_create(
+        AccountState(account=account, balance=balance)
+        for account, balance in balances.items()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('boocoin', '0006_unconfirmed_time_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountState',
+            fields=[
+                ('account', models.CharField(max_length=96, primary_key=True, serialize=False)),
+                ('balance', models.DecimalField(decimal_places=8, max_digits=20)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AccountTransaction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account', models.CharField(max_length=96)),
+                ('block', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='boocoin.Block')),
+                ('transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='boocoin.Transaction')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='accounttransaction',
+            index=models.Index(fields=['account', '-id'], name='boocoin_account_history_idx'),
+        ),
+        migrations.RunPython(build_account_index, migrations.RunPython.noop),
+    ]
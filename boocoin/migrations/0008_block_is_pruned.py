@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('boocoin', '0007_account_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='block',
+            name='is_pruned',
+            field=models.BooleanField(default=False),
+        ),
+    ]
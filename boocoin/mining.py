@@ -1,27 +1,79 @@
 import logging
+import queue
+import threading
 
 from django.conf import settings
-from django.db import transaction
+from django.db import close_old_connections
 from django.utils.timezone import now
 
-from boocoin.balances import apply_transactions_to_balances
-from boocoin.models import Block, Transaction, UnconfirmedTransaction, SyncLock
+from boocoin.balances import get_balance_changes, get_transaction_accounts
+from boocoin.mempool import get_mempool
+from boocoin.models import Block, Transaction, SyncLock
+from boocoin.util.db import atomic_write
 from boocoin.validation import prune_invalid_transactions, validate_block
 
 logger = logging.getLogger(__name__)
 
+# Holds at most one pending request to mine, so that requests made while one
+# is already waiting collapse into it
+mining_queue = queue.Queue(maxsize=1)
+mining_worker = None
+mining_worker_lock = threading.Lock()
+
 
 def is_time_to_mine():
     """
-    Returns whether or not there are either at least 10 unconfirmed
-    transactions, or it has been at least 10 minutes since the last block was
-    mined.
+    Returns whether or not there are either at least transaction_threshold
+    unconfirmed transactions, or it has been at least block_interval seconds
+    since the last block was mined (see Block.get_consensus_params).
     """
-    active_block = Block.get_active_block()
-    minutes_passed = (now() - active_block.time).total_seconds() / 60
-    if UnconfirmedTransaction.objects.count() >= 10 or minutes_passed > 10:
+    if is_transaction_threshold_met():
         return True
-    return False
+    active_block = Block.get_active_block()
+    seconds_passed = (now() - active_block.time).total_seconds()
+    return seconds_passed >= Block.get_consensus_params()['block_interval']
+
+
+def is_transaction_threshold_met():
+    """
+    Returns whether or not enough unconfirmed transactions are waiting to
+    mine a block right away.
+    """
+    threshold = Block.get_consensus_params()['transaction_threshold']
+    return len(get_mempool()) >= threshold
+
+
+def request_mining():
+    """
+    Asks the mining worker to mine a block if it's time to. This returns
+    immediately, and starts the worker the first time it is called.
+    """
+    global mining_worker
+    with mining_worker_lock:
+        if mining_worker is None:
+            mining_worker = threading.Thread(target=run_mining_worker)
+            mining_worker.setDaemon(True)
+            mining_worker.start()
+
+    try:
+        mining_queue.put_nowait(True)
+    except queue.Full:
+        pass
+
+
+def run_mining_worker():
+    """
+    Mines blocks as they are requested. All mining happens on this thread, so
+    blocks are never mined by two threads at once.
+    """
+    while True:
+        mining_queue.get()
+        close_old_connections()
+        try:
+            if is_time_to_mine():
+                mine_block()
+        except Exception as e:
+            logger.warn(f'Failed to mine block: {e}')
 
 
 def mine_block():
@@ -32,22 +84,43 @@ def mine_block():
 
     logger.debug('Mining new block...')
     broadcast = None
-    with transaction.atomic():
+    with atomic_write():
         # Get the active block
         active_block = Block.get_active_block()
         logger.debug(f'{active_block.id} is the active block.')
 
         # Collect the unconfirmed transactions
-        unconfirmed = UnconfirmedTransaction.objects.all()
+        mempool = get_mempool()
+        unconfirmed = mempool.get_ordered()
         logger.debug(f'{len(unconfirmed)} unconfirmed transactions found.')
 
-        # Prune invalid transactions
-        transactions = prune_invalid_transactions(active_block, unconfirmed)
+        # Prune invalid transactions and fill the block up to its limits,
+        # leaving room for the block reward
+        reward = Transaction.create_block_reward()
+        params = Block.get_consensus_params()
+        max_transactions = params['max_block_transactions']
+        max_bytes = params['max_block_bytes']
+        transactions = prune_invalid_transactions(
+            active_block,
+            unconfirmed,
+            max_transactions=max_transactions and max_transactions - 1,
+            max_bytes=max_bytes and max_bytes - reward.get_size(),
+        )
         logger.debug(f'{len(transactions)} transactions after pruning.')
 
+        # Pruning (or the size limits) may have left too few transactions to
+        # mine a block before the block interval has passed
+        seconds_passed = (now() - active_block.time).total_seconds()
+        if (
+            len(transactions) < params['transaction_threshold'] and
+            seconds_passed < params['block_interval']
+        ):
+            logger.debug('Not enough transactions to mine a block yet.')
+            return
+
         # Convert the unconfirmed transactions and add the block reward
         transactions = [u.to_transaction() for u in transactions]
-        transactions.insert(0, Transaction.create_block_reward())
+        transactions.insert(0, reward)
 
         # Set up the block
         block = Block(
@@ -58,10 +131,13 @@ def mine_block():
             time=now(),
         )
         block.set_merkle_root(transactions)
-        block.set_balances(apply_transactions_to_balances(
-            transactions,
-            active_block.get_balances(),
-        ))
+        balances = active_block.get_balances(
+            get_transaction_accounts(transactions)
+        )
+        block.set_balance_changes(
+            balances,
+            get_balance_changes(transactions, balances),
+        )
         block.set_hash()
         block.sign()
 
@@ -69,7 +145,6 @@ def mine_block():
         if validate_block(block, transactions):
             # Save the block
             block.save(transactions)
-            UnconfirmedTransaction.objects.all().delete()
             broadcast = block
             logger.info(f'Block {block.id} successfully mined.')
         else:
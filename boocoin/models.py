@@ -1,15 +1,49 @@
+import logging
 import simplejson as json
-from binascii import hexlify
 from collections import OrderedDict
 from decimal import Decimal
 
 from django.conf import settings
 from django.db import models, transaction as db_transaction
+from django.db.models import Q
 from django.utils.timezone import now
 
-from boocoin.hashing import create_hash, calculate_merkle_root
+from boocoin.ancestry import find_ancestor, get_skip_depth
+from boocoin.encoding import (
+    ENCODING_VERSION, encode_block, encode_transaction
+)
+from boocoin.hashing import (
+    EMPTY_BALANCES_HASH, MERKLE_NODE_SIZE, build_merkle_tree, create_hash,
+    calculate_merkle_root, get_balances_root, get_merkle_proof,
+    update_balances_hash
+)
+from boocoin.signals import tip_changed
 from boocoin.signing import sign
-from boocoin.util.db import query_value
+from boocoin.util.db import chunks, query
+
+logger = logging.getLogger(__name__)
+
+# Consensus parameters used when the genesis block doesn't specify them:
+#   miners: The public keys of the miners that are authorized to mine blocks.
+#   block_interval: The number of seconds after which a block may be mined,
+#       regardless of how many transactions are waiting.
+#   transaction_threshold: The number of unconfirmed transactions that allow
+#       a block to be mined before the block interval has passed.
+#   max_block_transactions: The most transactions a block may contain,
+#       including the block reward (None for no limit).
+#   max_block_bytes: The most bytes of transactions (see
+#       TransactionHashMixin.get_size) a block may contain (None for no limit).
+#   encoding_version: The version of boocoin.encoding that blocks and
+#       transactions are hashed with. Genesis blocks that don't specify it
+#       predate the binary encoding.
+DEFAULT_CONSENSUS_PARAMS = {
+    'miners': [],
+    'block_interval': 600,
+    'transaction_threshold': 10,
+    'max_block_transactions': None,
+    'max_block_bytes': None,
+    'encoding_version': 0,
+}
 
 
 class Block(models.Model):
@@ -33,10 +67,34 @@ class Block(models.Model):
         depth (int): The distance of the block from the beginning of the chain.
             This is used to quickly find the longest chain. Note that the depth
             of the genesis block is 0.
+        skip_block (str): The hash of an earlier ancestor of this block (see
+            boocoin.ancestry.get_skip_depth). Skip pointers allow any ancestor
+            to be found in O(log n) steps. This is local to each node and is
+            not included in the block's hash.
         miner (str): The public key of the miner that mined this block.
-        balances (str): A JSON string containing a dictionary of account
-            balances. Use get_balances() to properly parse balances as
-            decimals.
+        balances_root (str): A hash committing to the balance of every account
+            after this block's transactions are applied. Only the balances
+            that changed are stored with each block (see BalanceChange), so
+            use get_balances() to rebuild the full dictionary of balances.
+        balances_hash (bytes): The set hash of every account's balance that
+            balances_root is the hash of (see boocoin.hashing). It is kept so
+            that the next block's balances root can be calculated from the
+            accounts it changes. This is local to each node and is not
+            included in the block's hash.
+        legacy_balances (str): For blocks mined before balance changes were
+            stored, the JSON string of every account's balance that the
+            block was hashed with (see boocoin.encoding.encode_block_json).
+            This is None for every other block.
+        is_checkpoint (bool): Whether or not a complete snapshot of balances
+            is stored for this block (see BalanceCheckpoint). Checkpoints are
+            stored every BALANCE_CHECKPOINT_INTERVAL blocks so that balances
+            can be rebuilt without replaying the whole chain. This is local
+            to each node and is not included in the block's hash.
+        is_pruned (bool): Whether or not the block's transactions, merkle
+            tree and balance data have been deleted to save space (see
+            boocoin.pruning). Only the block itself and its TransactionIndex
+            rows are kept. This is local to each node and is not included in
+            the block's hash.
         merkle_root (str): The merkle root hash of all the balances included in
             this block.
         extra_data (bytes): Arbitrary data that can be included with the block
@@ -57,13 +115,31 @@ class Block(models.Model):
         on_delete=models.CASCADE
     )
     depth = models.IntegerField()
+    skip_block = models.ForeignKey(
+        'self',
+        null=True,
+        related_name='+',
+        on_delete=models.CASCADE
+    )
     miner = models.CharField(max_length=96)
-    balances = models.TextField()
+    balances_root = models.CharField(max_length=64)
+    balances_hash = models.BinaryField()
+    legacy_balances = models.TextField(null=True)
+    is_checkpoint = models.BooleanField(default=False)
+    is_pruned = models.BooleanField(default=False)
     merkle_root = models.CharField(max_length=64)
     extra_data = models.BinaryField(null=True)
     time = models.DateTimeField()
     signature = models.CharField(max_length=96)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['-depth', 'id'], name='boocoin_block_tip_idx'),
+        ]
+
+    # Loaded from the genesis block by get_consensus_params
+    consensus_params = None
+
     @classmethod
     def get_genesis_block(cls):
         """
@@ -72,48 +148,316 @@ class Block(models.Model):
         """
         return cls.objects.get(depth=0)
 
+    @classmethod
+    def get_consensus_params(cls):
+        """
+        Returns the consensus parameters that every node must agree on, which
+        are stored in the genesis block's extra_data. See
+        DEFAULT_CONSENSUS_PARAMS for the parameters. The genesis block never
+        changes, so they are only loaded once.
+
+        Older genesis blocks only contain a list of authorized miners, and
+        use the default values for everything else.
+        """
+        if cls.consensus_params is None:
+            genesis_block = cls.get_genesis_block()
+            params = json.loads(bytes(genesis_block.extra_data).decode('utf-8'))
+            if isinstance(params, list):
+                params = {'miners': params}
+            cls.consensus_params = dict(DEFAULT_CONSENSUS_PARAMS, **params)
+        return cls.consensus_params
+
+    @classmethod
+    def get_encoding_version(cls):
+        """
+        Returns the version of boocoin.encoding that blocks and transactions
+        are hashed with. The genesis block is hashed with the current version
+        while it is being generated.
+        """
+        if (
+            cls.consensus_params is None and
+            not cls.objects.filter(depth=0).exists()
+        ):
+            return ENCODING_VERSION
+        return cls.get_consensus_params()['encoding_version']
+
+    @classmethod
+    def get_authorized_miners(cls):
+        """
+        Returns the public keys of the miners that are authorized to mine
+        blocks, which are stored in the genesis block's extra_data.
+        """
+        return cls.get_consensus_params()['miners']
+
     @classmethod
     def get_active_block(cls):
         """
         Returns the latest block in the longest chain. If two blocks have the
         same depth, the block whose hash comes first alphabetically will be
-        chosen.
+        chosen. See ChainTip.
+        """
+        return ChainTip.get().block
+
+    @classmethod
+    def find_active_block(cls):
+        """
+        Searches every block for the active block. This is only needed when
+        the chain tip hasn't been recorded yet; use get_active_block()
+        otherwise.
         """
         return cls.objects.order_by('-depth', 'id')[:1][0]
 
-    def get_balances(self):
+    @classmethod
+    def get_ancestry_pointers(cls, block_id):
+        """
+        Returns the (previous_block_id, skip_block_id) of the given block.
+        """
+        return cls.objects.values_list(
+            'previous_block_id', 'skip_block_id'
+        ).get(id=block_id)
+
+    @classmethod
+    def get_ancestry(cls, block_id, count=None, until_checkpoint=False):
+        """
+        Returns a list of (id, is_checkpoint) tuples for the block and its
+        ancestors, newest first, using a single query. The list stops after
+        count blocks, or after the first checkpoint if until_checkpoint is
+        set. Otherwise it goes all the way back to the genesis block.
+        """
+        conditions = []
+        args = [block_id]
+        if count is not None:
+            conditions.append('a.n < %s')
+            args.append(count)
+        if until_checkpoint:
+            conditions.append('NOT a.is_checkpoint')
+        where = ' AND '.join(conditions) or '1 = 1'
+
+        rows = query(f"""
+            WITH RECURSIVE
+            ancestors(id, previous_block_id, is_checkpoint, n) AS (
+                SELECT id, previous_block_id, is_checkpoint, 1
+                    FROM boocoin_block
+                    WHERE id = %s
+                UNION ALL
+                SELECT b.id, b.previous_block_id, b.is_checkpoint, a.n + 1
+                    FROM boocoin_block b
+                    INNER JOIN ancestors a ON b.id = a.previous_block_id
+                    WHERE {where}
+            )
+            SELECT id, is_checkpoint FROM ancestors ORDER BY n;
+        """, *args)
+        return [(row[0], bool(row[1])) for row in rows]
+
+    @classmethod
+    def get_descendant_ids(cls, block_id):
+        """
+        Returns the ids of the block and every block that descends from it,
+        on any fork, using a single query.
+        """
+        rows = query("""
+            WITH RECURSIVE
+            descendants(id) AS (
+                SELECT id
+                    FROM boocoin_block
+                    WHERE id = %s
+                UNION ALL
+                SELECT b.id
+                    FROM boocoin_block b
+                    INNER JOIN descendants d ON b.previous_block_id = d.id
+            )
+            SELECT id FROM descendants;
+        """, block_id)
+        return [row[0] for row in rows]
+
+    def get_ancestor_ids(self, count):
+        """
+        Returns the ids of this block and up to count - 1 of its ancestors,
+        newest first, without loading any other block data.
+        """
+        return [block_id for block_id, _ in Block.get_ancestry(self.id, count)]
+
+    def get_locator(self):
+        """
+        Returns a block locator: the ids of this block and its ancestors,
+        starting with the 10 most recent blocks and then doubling the step
+        back each time, always ending with the genesis block. A peer can find
+        the most recent block we have in common with it from a locator, no
+        matter how far apart our chains are.
         """
-        Returns a dictionary of decimal balances, keyed by public key.
+        depths = []
+        depth = self.depth
+        step = 1
+        while depth > 0:
+            depths.append(depth)
+            if len(depths) >= 10:
+                step *= 2
+            depth -= step
+        depths.append(0)
+
+        locator = []
+        ancestor = (self.id, self.depth)
+        for depth in depths:
+            ancestor = (self.get_ancestor_id(depth, start=ancestor), depth)
+            locator.append(ancestor[0])
+        return locator
+
+    def find_common_block(self, locator):
+        """
+        Returns an (id, depth) tuple for the first block in the locator that is
+        in this block's chain, or None if there isn't one.
+        """
+        depths = dict(Block.objects.filter(
+            id__in=locator
+        ).values_list('id', 'depth'))
+        for block_id in locator:
+            depth = depths.get(block_id)
+            if depth is not None and self.get_ancestor_id(depth) == block_id:
+                return (block_id, depth)
+        return None
+
+    def get_ancestor_id(self, depth, start=None):
         """
-        balances = json.loads(self.balances, object_pairs_hook=OrderedDict)
-        for a, b in balances.items():
-            balances[a] = Decimal(b)
+        Returns the id of this block's ancestor at the given depth (which may
+        be this block itself), or None if the depth is out of range.
+
+        A (block_id, depth) tuple for one of this block's ancestors can be
+        passed as start to continue a previous walk from that ancestor.
+        """
+        if depth < 0 or depth > self.depth:
+            return None
+
+        def get_pointers(block_id):
+            if block_id == self.id:
+                return (self.previous_block_id, self.skip_block_id)
+            return Block.get_ancestry_pointers(block_id)
+
+        block_id, block_depth = start or (self.id, self.depth)
+        return find_ancestor(block_id, block_depth, depth, get_pointers)
+
+    @classmethod
+    def find_fork(cls, from_block, to_block, page_size=100):
+        """
+        Compares two chains, given (id, depth) tuples for the blocks at their
+        tips. Returns a tuple of the ids of the blocks that are only in the
+        first chain (newest first), and the ids of the blocks that are only in
+        the second chain (oldest first). These are the blocks that leave and
+        join the active chain when the tip moves from one block to the other.
+        """
+        def get_ancestor_ids(block_id, count):
+            return [i for i, _ in cls.get_ancestry(block_id, count)]
+
+        from_id, from_depth = from_block
+        to_id, to_depth = to_block
+        disconnected = []
+        connected = []
+
+        # Walk the deeper chain back to the depth of the other one
+        if from_depth > to_depth:
+            ancestry = get_ancestor_ids(from_id, from_depth - to_depth + 1)
+            disconnected.extend(ancestry[:-1])
+            from_id = ancestry[-1]
+        elif to_depth > from_depth:
+            ancestry = get_ancestor_ids(to_id, to_depth - from_depth + 1)
+            connected.extend(ancestry[:-1])
+            to_id = ancestry[-1]
+
+        # Walk both chains back a page at a time until they meet. The last
+        # block of each page is where the next page starts.
+        depth = min(from_depth, to_depth)
+        while from_id != to_id:
+            if depth == 0:
+                raise ValueError('Blocks do not share a genesis block.')
+            count = min(page_size, depth) + 1
+            from_ancestry = get_ancestor_ids(from_id, count)
+            to_ancestry = get_ancestor_ids(to_id, count)
+            for i in range(count):
+                from_id, to_id = from_ancestry[i], to_ancestry[i]
+                if from_id == to_id or i == count - 1:
+                    break
+                disconnected.append(from_id)
+                connected.append(to_id)
+            depth -= count - 1
+
+        connected.reverse()
+        return disconnected, connected
+
+    def set_skip_block(self):
+        """
+        Calculates and stores the skip pointer of the block.
+        """
+        if self.previous_block:
+            self.skip_block_id = self.previous_block.get_ancestor_id(
+                get_skip_depth(self.depth)
+            )
+
+    def get_balances(self, accounts=None):
+        """
+        Returns a dictionary of decimal balances, keyed by public key. The
+        balances are rebuilt from the nearest checkpoint by replaying the
+        balance changes of every block that follows it.
+
+        If accounts are provided, only the balances of those accounts are
+        loaded. Accounts that do not exist yet are left out.
+        """
+        # Find every block back to (and including) the nearest checkpoint
+        ancestry = Block.get_ancestry(self.id, until_checkpoint=True)
+        block_ids = [block_id for block_id, _ in ancestry]
+        checkpoint_id = block_ids.pop() if ancestry[-1][1] else None
+
+        balances = OrderedDict()
+        account_chunks = [None] if accounts is None else chunks(accounts)
+        for chunk in account_chunks:
+            checkpoint = BalanceCheckpoint.objects.filter(
+                block_id=checkpoint_id
+            )
+            changes = BalanceChange.objects.filter(
+                block_id__in=block_ids
+            ).order_by('block__depth')
+            if chunk is not None:
+                checkpoint = checkpoint.filter(account__in=chunk)
+                changes = changes.filter(account__in=chunk)
+
+            # Start with the checkpoint's balances (if we found one)
+            if checkpoint_id:
+                balances.update(checkpoint.values_list('account', 'balance'))
+
+            # Play the balance changes over the checkpoint, oldest first
+            balances.update(changes.values_list('account', 'balance'))
         return balances
 
-    def set_balances(self, balances):
+    def set_balance_changes(self, previous_balances, balances):
         """
-        Updates the block's balances.
+        Stores the balances that were changed by the block's transactions and
+        updates the block's balances root. Accepts the balances of the
+        previous block, along with the new balances of the changed accounts.
         """
-        self.balances = json.dumps(balances)
+        self.pending_balance_changes = [
+            BalanceChange(
+                account=account,
+                previous_balance=previous_balances.get(account),
+                balance=balance,
+            )
+            for account, balance in balances.items()
+        ]
+
+        previous_hash = EMPTY_BALANCES_HASH
+        if self.previous_block:
+            previous_hash = self.previous_block.balances_hash
+        self.balances_hash = update_balances_hash(
+            previous_hash,
+            previous_balances,
+            balances,
+        )
+        self.balances_root = get_balances_root(self.balances_hash)
 
     def calculate_hash(self):
         """
         Serializes all of the block's data and returns the hash of the block.
         """
-        extra_data = None
-        if self.extra_data:
-            extra_data = hexlify(self.extra_data).decode('utf-8')
-
-        data = json.dumps(OrderedDict([
-            ('previous_block', self.previous_block_id),
-            ('depth', self.depth),
-            ('miner', self.miner),
-            ('balances', self.balances),
-            ('merkle_root', self.merkle_root),
-            ('extra_data', extra_data),
-            ('time', self.time),
-        ]), default=str)
-        return create_hash(data)
+        return create_hash(
+            encode_block(self, version=Block.get_encoding_version())
+        )
 
     def set_hash(self):
         """
@@ -134,42 +478,196 @@ class Block(models.Model):
         """
         self.signature = sign(self.id)
 
-    def save(self, transactions):
+    def save(self, transactions, writer=None):
         """
-        Saves the block along with its transactions.
+        Saves the block along with its transactions and balance changes. A
+        balances checkpoint is also stored every BALANCE_CHECKPOINT_INTERVAL
+        blocks.
+
+        When saving several blocks in a row, pass the same BlockWriter to each
+        call and flush it afterwards, so that the rows the following blocks
+        don't need are inserted all at once.
         """
+        self.set_skip_block()
+
         with db_transaction.atomic():
             super().save()
-            for t in transactions:
-                t.block = self
-                t.save()
+            TransactionIndex.objects.bulk_create(
+                TransactionIndex(hash=t.hash, block=self, depth=self.depth)
+                for t in transactions
+            )
+
+            for change in self.pending_balance_changes:
+                change.block = self
+            BalanceChange.objects.bulk_create(self.pending_balance_changes)
+
+            if self.depth % settings.BALANCE_CHECKPOINT_INTERVAL == 0:
+                self.save_balances_checkpoint()
+
+            if writer is None:
+                BlockWriter().add(self, transactions).flush()
+            else:
+                writer.add(self, transactions)
+
+    def save_balances_checkpoint(self):
+        """
+        Stores a complete snapshot of the block's balances.
+        """
+        BalanceCheckpoint.objects.bulk_create(
+            BalanceCheckpoint(block=self, account=account, balance=balance)
+            for account, balance in self.get_balances().items()
+        )
+        self.is_checkpoint = True
+        super().save(update_fields=['is_checkpoint'])
+
+    def find_transaction_block(self, tx_hash):
+        """
+        Returns the hash of the block upstream in the chain (including this
+        block) that contains the transaction, or None if there isn't one.
+        """
+        candidates = TransactionIndex.objects.filter(
+            hash=tx_hash,
+            depth__lte=self.depth,
+        ).values_list('block_id', 'depth')
+        for block_id, depth in candidates:
+            if self.get_ancestor_id(depth) == block_id:
+                return block_id
+        return None
 
     def has_transaction_in_chain(self, tx_hash):
         """
         Returns whether or not the provided transaction exists anywhere
         upstream in the chain (including this block).
         """
-        return bool(query_value("""
-            WITH RECURSIVE
-            txsearch(block_id, parent_id, has_tx) AS (
-                SELECT b.id, b.previous_block_id, t.hash
-                    FROM boocoin_block b
-                    LEFT JOIN boocoin_transaction t
-                        ON t.block_id = b.id AND t.hash = %s
-                    WHERE b.id = %s
-                UNION ALL
-                SELECT b.id, b.previous_block_id, t.hash
-                    FROM boocoin_block b
-                    INNER JOIN txsearch p ON p.parent_id = b.id
-                    LEFT JOIN boocoin_transaction t
-                        ON t.block_id = b.id AND t.hash = %s
-                    WHERE b.id IS NOT NULL
-                    LIMIT 100
-            )
-            SELECT CASE WHEN COUNT(*) THEN 1 ELSE 0 END AS tx_found
-            FROM txsearch
-            WHERE has_tx IS NOT NULL;
-        """, tx_hash, self.id, tx_hash))
+        return bool(self.find_transactions_in_chain([tx_hash]))
+
+    def find_transactions_in_chain(self, tx_hashes):
+        """
+        Returns the set of provided transaction hashes that exist anywhere
+        upstream in the chain (including this block).
+
+        All of the blocks containing the transactions are looked up at once,
+        and only those that are deep enough to be in this chain are checked.
+        Those are usually blocks on other forks, which are ruled out by
+        comparing them with this block's ancestor at the same depth.
+        """
+        candidates = []
+        for chunk in chunks(tx_hashes):
+            candidates.extend(TransactionIndex.objects.filter(
+                hash__in=chunk,
+                depth__lte=self.depth,
+            ).values_list('hash', 'block_id', 'depth'))
+
+        # Check the deepest candidates first, so that each ancestor lookup
+        # can carry on from where the last one finished
+        found = set()
+        ancestor = (self.id, self.depth)
+        for tx_hash, block_id, depth in sorted(candidates, key=lambda c: -c[2]):
+            if depth != ancestor[1]:
+                ancestor = (self.get_ancestor_id(depth, start=ancestor), depth)
+            if block_id == ancestor[0]:
+                found.add(tx_hash)
+        return found
+
+
+class BlockWriter:
+    """
+    Holds back the rows of saved blocks that aren't needed to validate the
+    blocks after them: their transactions, their merkle trees and the chain
+    tip. flush() inserts them with a few bulk statements, and must be called
+    in the same database transaction as the blocks were saved in.
+
+    Attributes:
+        transactions (list): The transactions waiting to be inserted.
+        merkle_trees (list): The merkle trees waiting to be inserted.
+        tip (boocoin.models.Block): The block that would beat all of the
+            others as the chain tip (see ChainTip.advance).
+    """
+
+    def __init__(self):
+        self.transactions = []
+        self.merkle_trees = []
+        self.tip = None
+
+    def add(self, block, transactions):
+        """
+        Adds a block's rows to be inserted. Returns the writer.
+        """
+        for t in transactions:
+            t.block = block
+        self.transactions.extend(transactions)
+        self.merkle_trees.append(MerkleTree.build(block, transactions))
+
+        if (
+            self.tip is None or
+            block.depth > self.tip.depth or
+            (block.depth == self.tip.depth and block.id < self.tip.id)
+        ):
+            self.tip = block
+        return self
+
+    def flush(self):
+        """
+        Inserts every row that has been added, and advances the chain tip.
+        """
+        Transaction.objects.bulk_create(self.transactions)
+        MerkleTree.objects.bulk_create(self.merkle_trees)
+        if self.tip is not None:
+            ChainTip.advance(self.tip)
+        self.__init__()
+
+
+class BalanceChange(models.Model):
+    """
+    Stores the new balance of an account that was changed by a block. Only the
+    accounts touched by a block's transactions are stored, so the size of a
+    block's balance data is proportional to its transactions rather than the
+    number of accounts.
+
+    Attributes:
+        block (boocoin.models.Block): The block that changed the balance.
+        account (str): The public key of the account.
+        previous_balance (Decimal): The balance of the account before the
+            block, or None if the account did not exist yet.
+        balance (Decimal): The balance of the account after the block.
+    """
+    block = models.ForeignKey(
+        Block,
+        related_name='balance_changes',
+        on_delete=models.CASCADE
+    )
+    account = models.CharField(max_length=96, db_index=True)
+    previous_balance = models.DecimalField(
+        max_digits=20,
+        decimal_places=8,
+        null=True
+    )
+    balance = models.DecimalField(max_digits=20, decimal_places=8)
+
+    class Meta:
+        unique_together = (('block', 'account'),)
+
+
+class BalanceCheckpoint(models.Model):
+    """
+    A complete snapshot of every account's balance as of a checkpoint block.
+    Balances for any block are rebuilt from the nearest checkpoint before it.
+
+    Attributes:
+        block (boocoin.models.Block): The checkpoint block.
+        account (str): The public key of the account.
+        balance (Decimal): The balance of the account as of the block.
+    """
+    block = models.ForeignKey(
+        Block,
+        related_name='balance_checkpoints',
+        on_delete=models.CASCADE
+    )
+    account = models.CharField(max_length=96)
+    balance = models.DecimalField(max_digits=20, decimal_places=8)
+
+    class Meta:
+        unique_together = (('block', 'account'),)
 
 
 class TransactionHashMixin:
@@ -178,22 +676,33 @@ class TransactionHashMixin:
     UnconfirmedTransaction models to share this logic.
     """
 
+    def serialize(self):
+        """
+        Serializes all of the transaction's data that is covered by its hash.
+        Returns bytes (see boocoin.encoding).
+        """
+        return encode_transaction(
+            self,
+            version=Block.get_encoding_version(),
+        )
+
     def calculate_hash(self):
         """
         Serializes all of the transactions's data and returns the hash.
         """
-        extra_data = None
-        if self.extra_data:
-            extra_data = hexlify(self.extra_data).decode('utf-8')
+        return create_hash(self.serialize())
 
-        data = json.dumps(OrderedDict([
-            ('from_account', self.from_account),
-            ('to_account', self.to_account),
-            ('coins', self.coins),
-            ('extra_data', extra_data),
-            ('time', self.time),
-        ]), default=str)
-        return create_hash(data)
+    def get_size(self):
+        """
+        Returns the size of the transaction in bytes, as counted towards the
+        max_block_bytes consensus parameter. This is the size of its
+        serialized data, its hash and its signature.
+        """
+        return (
+            len(self.serialize()) +
+            len(self.hash) +
+            len(self.signature)
+        )
 
 
 class Transaction(TransactionHashMixin, models.Model):
@@ -252,6 +761,20 @@ class Transaction(TransactionHashMixin, models.Model):
         """
         self.hash = self.calculate_hash()
 
+    def to_unconfirmed_transaction(self):
+        """
+        Maps the transaction's data and returns an UnconfirmedTransaction.
+        """
+        return UnconfirmedTransaction(
+            hash=self.hash,
+            from_account=self.from_account,
+            to_account=self.to_account,
+            coins=self.coins,
+            extra_data=self.extra_data,
+            time=self.time,
+            signature=self.signature,
+        )
+
     @classmethod
     def create_block_reward(cls):
         """
@@ -269,6 +792,97 @@ class Transaction(TransactionHashMixin, models.Model):
         return reward
 
 
+class TransactionIndex(models.Model):
+    """
+    Maps transaction hashes to the blocks that contain them. This is used to
+    quickly check whether a transaction is already in a chain, which prevents
+    replay attacks.
+
+    The depth of each block is stored alongside it, so blocks that are too
+    deep to be in a given chain can be ruled out without looking them up.
+
+    Attributes:
+        hash (str): The hash of the transaction.
+        block (boocoin.models.Block): A block that contains the transaction.
+        depth (int): The depth of the block.
+    """
+    hash = models.CharField(max_length=64, db_index=True)
+    block = models.ForeignKey(
+        Block,
+        related_name='transaction_index',
+        on_delete=models.CASCADE
+    )
+    depth = models.IntegerField()
+
+    class Meta:
+        unique_together = (('hash', 'block'),)
+
+
+class MerkleTree(models.Model):
+    """
+    The complete merkle tree of a block's transactions, which is stored so
+    that proofs of inclusion can be served without rebuilding it.
+
+    Attributes:
+        block (boocoin.models.Block): The block the tree belongs to.
+        leaf_count (int): The number of leaves (transactions) in the tree.
+        nodes (bytes): The digest of every node in the tree concatenated,
+            level by level, starting with the leaves.
+    """
+    block = models.OneToOneField(
+        Block,
+        primary_key=True,
+        related_name='merkle_tree',
+        on_delete=models.CASCADE
+    )
+    leaf_count = models.IntegerField()
+    nodes = models.BinaryField()
+
+    @classmethod
+    def build(cls, block, transactions):
+        """
+        Builds (but doesn't save) the merkle tree for a block's transactions.
+        """
+        levels = build_merkle_tree(t.hash for t in transactions)
+        return cls(
+            block=block,
+            leaf_count=len(levels[0]),
+            nodes=b''.join(node for level in levels for node in level),
+        )
+
+    def get_levels(self):
+        """
+        Returns the levels of the tree (see boocoin.hashing.build_merkle_tree).
+        """
+        nodes = bytes(self.nodes)
+        levels = []
+        size = self.leaf_count
+        offset = 0
+        while True:
+            levels.append([
+                nodes[offset + i * MERKLE_NODE_SIZE:
+                      offset + (i + 1) * MERKLE_NODE_SIZE]
+                for i in range(size)
+            ])
+            offset += size * MERKLE_NODE_SIZE
+            if size <= 1:
+                return levels
+            size = (size + 1) // 2
+
+    def get_proof(self, tx_hash):
+        """
+        Returns the index of the transaction in the block along with the proof
+        that it is in the tree (see boocoin.hashing.get_merkle_proof), or None
+        if it isn't in the tree.
+        """
+        levels = self.get_levels()
+        try:
+            index = levels[0].index(bytes.fromhex(tx_hash))
+        except ValueError:
+            return None
+        return index, get_merkle_proof(levels, index)
+
+
 class UnconfirmedTransaction(TransactionHashMixin, models.Model):
     """
     Unconfirmed transactions are simply transactions that haven't been included
@@ -286,6 +900,15 @@ class UnconfirmedTransaction(TransactionHashMixin, models.Model):
     time = models.DateTimeField()
     signature = models.CharField(max_length=96)
 
+    class Meta:
+        indexes = [
+            # The order that unconfirmed transactions are mined in
+            models.Index(
+                fields=['time', 'hash'],
+                name='boocoin_unconfirmed_time_idx',
+            ),
+        ]
+
     def to_transaction(self):
         """
         Maps the unconfirmed transaction's data and returns a Transaction.
@@ -309,3 +932,214 @@ class SyncLock(models.Model):
     with the rest of the network.
     """
     node = models.CharField(max_length=255)
+
+
+class ChainTip(models.Model):
+    """
+    Records the active block (the latest block in the longest chain), so that
+    it doesn't need to be searched for. There is only ever one row, which is
+    advanced whenever a block that beats it is saved.
+
+    Attributes:
+        block (boocoin.models.Block): The active block.
+        depth (int): The depth of the active block.
+    """
+    block = models.ForeignKey(
+        Block,
+        related_name='+',
+        on_delete=models.CASCADE
+    )
+    depth = models.IntegerField()
+
+    @classmethod
+    def get(cls):
+        """
+        Returns the chain tip, finding it from scratch if it hasn't been
+        recorded yet.
+        """
+        try:
+            return cls.objects.select_related('block').get(pk=1)
+        except cls.DoesNotExist:
+            return cls.reset()
+
+    @classmethod
+    def reset(cls):
+        """
+        Searches every block for the active block, and records it as the chain
+        tip. The account index is rebuilt to match.
+        """
+        block = Block.find_active_block()
+        with db_transaction.atomic():
+            tip, _ = cls.objects.update_or_create(pk=1, defaults={
+                'block': block,
+                'depth': block.depth,
+            })
+            AccountState.rebuild(block)
+        return tip
+
+    @classmethod
+    def advance(cls, block):
+        """
+        Records the block as the chain tip if it beats the current tip. A block
+        beats the tip if it is deeper, or it is at the same depth and its hash
+        comes first alphabetically. Returns whether or not the tip changed.
+
+        This is a single conditional update, so concurrent saves can never
+        move the tip backwards.
+
+        When the tip moves, the blocks that leave the active chain (if the
+        block is on another fork) are rolled back and the blocks that join it
+        are applied, using only the balance changes of those blocks. The
+        tip_changed signal is sent with both lists of blocks once the change
+        has been committed, so that other state (like the pool of unconfirmed
+        transactions) can follow along.
+        """
+        previous = cls.objects.select_for_update().filter(
+            pk=1
+        ).values_list('block_id', 'depth').first()
+        changed = cls.objects.filter(pk=1).filter(
+            Q(depth__lt=block.depth) |
+            Q(depth=block.depth, block_id__gt=block.id)
+        ).update(block=block, depth=block.depth)
+
+        disconnected, connected = [], []
+        if changed:
+            disconnected, connected = Block.find_fork(
+                previous,
+                (block.id, block.depth),
+            )
+            if disconnected:
+                logger.info(
+                    f'Reorganizing chain at depth '
+                    f'{block.depth - len(connected)}: {len(disconnected)} '
+                    f'blocks disconnected, {len(connected)} connected.'
+                )
+            AccountState.apply_fork(disconnected, connected)
+        elif previous is None:
+            # The tip hasn't been recorded yet
+            changed = cls.reset().block_id == block.id
+
+        if changed:
+            db_transaction.on_commit(lambda: tip_changed.send(
+                sender=cls,
+                block=block,
+                disconnected=disconnected,
+                connected=connected,
+            ))
+        return bool(changed)
+
+
+class AccountState(models.Model):
+    """
+    The balance of every account as of the active block (see ChainTip). It is
+    updated as blocks join and leave the active chain, so that balances can be
+    looked up without replaying balance changes.
+
+    Attributes:
+        account (str): The public key of the account.
+        balance (Decimal): The balance of the account.
+    """
+    account = models.CharField(max_length=96, primary_key=True)
+    balance = models.DecimalField(max_digits=20, decimal_places=8)
+
+    @classmethod
+    def apply_fork(cls, disconnected, connected):
+        """
+        Updates the balances and AccountTransaction rows of every account
+        touched by the blocks that left the active chain (newest first) and
+        the blocks that joined it (oldest first). See Block.find_fork.
+        """
+        # Undo the disconnected blocks, newest first, so that each account
+        # ends up with its balance from before the oldest of them. Then
+        # replay the connected blocks, oldest first.
+        balances = {}
+        for block_ids, ordering, field in (
+            (disconnected, '-block__depth', 'previous_balance'),
+            (connected, 'block__depth', 'balance'),
+        ):
+            for chunk in chunks(block_ids):
+                balances.update(BalanceChange.objects.filter(
+                    block_id__in=chunk,
+                ).order_by(ordering).values_list('account', field))
+
+        for chunk in chunks(balances):
+            cls.objects.filter(account__in=chunk).delete()
+        cls.objects.bulk_create(
+            cls(account=account, balance=balance)
+            for account, balance in balances.items()
+            if balance is not None
+        )
+
+        for chunk in chunks(disconnected):
+            AccountTransaction.objects.filter(block_id__in=chunk).delete()
+        AccountTransaction.add_blocks(connected)
+
+    @classmethod
+    def rebuild(cls, block):
+        """
+        Rebuilds every account's balance and AccountTransaction rows as of the
+        given block. Transactions that have been pruned are left out of the
+        account history.
+        """
+        cls.objects.all().delete()
+        cls.objects.bulk_create(
+            cls(account=account, balance=balance)
+            for account, balance in block.get_balances().items()
+        )
+
+        AccountTransaction.objects.all().delete()
+        chain = block.get_ancestor_ids(block.depth + 1)
+        AccountTransaction.add_blocks(list(reversed(chain)))
+
+
+class AccountTransaction(models.Model):
+    """
+    Indexes the transactions in the active chain by the accounts that sent
+    and received them, so that an account's history can be paged through.
+    Rows are added as blocks join the active chain and removed as they leave
+    it, so ordering them by id always puts them in chain order.
+
+    Attributes:
+        account (str): The public key of the account.
+        transaction (boocoin.models.Transaction): The transaction.
+        block (boocoin.models.Block): The block the transaction is in.
+    """
+    account = models.CharField(max_length=96)
+    transaction = models.ForeignKey(
+        Transaction,
+        related_name='+',
+        on_delete=models.CASCADE
+    )
+    block = models.ForeignKey(
+        Block,
+        related_name='+',
+        on_delete=models.CASCADE
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['account', '-id'],
+                name='boocoin_account_history_idx',
+            ),
+        ]
+
+    @classmethod
+    def add_blocks(cls, block_ids):
+        """
+        Adds the transactions of the given blocks (oldest first).
+        """
+        for chunk in chunks(block_ids):
+            positions = {block_id: i for i, block_id in enumerate(chunk)}
+            transactions = sorted(
+                Transaction.objects.filter(block_id__in=chunk).values_list(
+                    'id', 'block_id', 'from_account', 'to_account'
+                ),
+                key=lambda t: (positions[t[1]], t[0]),
+            )
+            cls.objects.bulk_create(
+                cls(account=account, transaction_id=tx_id, block_id=block_id)
+                for tx_id, block_id, from_account, to_account in transactions
+                for account in (from_account, to_account)
+                if account
+            )
@@ -1,20 +1,84 @@
+import json
 import logging
+import threading
 from base64 import b64decode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
-from django.db import transaction as db_transaction
 from django.conf import settings
+from django.db import connection
+from django.utils.timezone import now
 
-from boocoin.mining import mine_block, is_time_to_mine
-from boocoin.models import Block, SyncLock, Transaction, UnconfirmedTransaction
+from boocoin.gossip import broadcast
+from boocoin.mempool import get_mempool
+from boocoin.mining import is_time_to_mine, request_mining
+from boocoin.models import Block, BlockWriter, SyncLock, Transaction
 from boocoin.serializers import (
     BlockSerializer, RemoteBlockTransactionSerializer,
     UnconfirmedTransactionSerializer
 )
-from boocoin.validation import validate_block
+from boocoin.signing import verify_many
+from boocoin.util.db import atomic_write, chunks
+from boocoin.validation import get_transaction_signatures, validate_block
 
 logger = logging.getLogger(__name__)
 
+# Held while a sync started by start_sync is running
+background_sync_lock = threading.Lock()
+
+
+class SyncProgress:
+    """
+    Thread-safe progress counters for the current (or most recent) sync,
+    which are exposed through the sync status API.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.node = None
+        self.started = None
+        self.target_depth = None
+        self.blocks_downloaded = 0
+        self.blocks_processed = 0
+        self.batches_committed = 0
+
+    def start(self, node):
+        """
+        Resets the counters for a new sync with the node.
+        """
+        with self.lock:
+            self.node = node
+            self.started = now()
+            self.target_depth = None
+            self.blocks_downloaded = 0
+            self.blocks_processed = 0
+            self.batches_committed = 0
+
+    def update(self, target_depth=None, **counts):
+        """
+        Sets the depth we're syncing to, and adds to any other counters.
+        """
+        with self.lock:
+            if target_depth is not None:
+                self.target_depth = target_depth
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'node': self.node,
+                'started': self.started,
+                'target_depth': self.target_depth,
+                'blocks_downloaded': self.blocks_downloaded,
+                'blocks_processed': self.blocks_processed,
+                'batches_committed': self.batches_committed,
+            }
+
+
+sync_progress = SyncProgress()
+
 
 def normalize_node(node):
     """
@@ -34,31 +98,102 @@ def get_nodes():
 
 def broadcast_transaction(transaction):
     """
-    Broadcasts a transaction to all of the configured nodes.
+    Announces a transaction to all of the configured nodes in the background.
+    Nodes respond with the transactions they don't have yet, which are then
+    sent to them. Transactions announced in quick succession are batched.
     """
-    data = UnconfirmedTransactionSerializer(transaction).data
-    for node in get_nodes():
-        try:
-            requests.post(f'{node}/p2p/transmit_transaction/', data, timeout=5)
-        except Exception as e:
-            logger.warn(str(e))
-            continue
+    broadcast(
+        get_nodes(),
+        '/p2p/inventory/',
+        transaction.hash,
+        batch_key='transactions',
+        callback=send_transactions,
+    )
 
 
 def broadcast_block(block):
     """
-    Broadcasts a block to all of the configured nodes.
+    Announces a block to all of the configured nodes in the background. Nodes
+    that don't have the block yet are sent a compact version of it.
+    """
+    broadcast(
+        get_nodes(),
+        '/p2p/inventory/',
+        block.id,
+        batch_key='blocks',
+        callback=send_blocks,
+    )
+
+
+def send_transactions(peer, response):
+    """
+    Sends a peer the unconfirmed transactions it requested in response to an
+    inventory announcement.
+    """
+    if not response.ok:
+        return
+    requested = response.json().get('transactions', [])
+    mempool = get_mempool()
+    for chunk in chunks(requested, size=settings.GOSSIP_BATCH_SIZE):
+        transactions = [t for t in map(mempool.get, chunk) if t]
+        if transactions:
+            peer.post('/p2p/transmit_transactions/', {
+                'transactions': UnconfirmedTransactionSerializer(
+                    transactions,
+                    many=True,
+                ).data,
+            })
+
+
+def send_blocks(peer, response):
+    """
+    Sends a peer the blocks it requested in response to an inventory
+    announcement. Each block is sent compactly, with transaction hashes in
+    place of the transactions that the peer should already have. If the peer
+    is missing any of them, the block is resent with those transactions.
+    """
+    if not response.ok:
+        return
+    requested = response.json().get('blocks', [])
+    blocks = Block.objects.prefetch_related('transactions').in_bulk(requested)
+    for block_id in requested:
+        if block_id not in blocks:
+            continue
+        block = blocks[block_id]
+        transactions = {t.hash: t for t in block.transactions.all()}
+        data = get_compact_block(block, list(transactions)[:1])
+        response = peer.post('/p2p/transmit_compact_block/', data)
+        if response is None or not response.ok:
+            continue
+
+        missing = response.json().get('missing')
+        if missing:
+            data['block']['transactions'].extend(
+                RemoteBlockTransactionSerializer(transactions[h]).data
+                for h in missing
+                if h in transactions
+            )
+            peer.post('/p2p/transmit_compact_block/', data)
+
+
+def get_compact_block(block, transactions):
+    """
+    Returns the data for a compact block, which lists the hashes of all of
+    the block's transactions but only includes the data for the provided
+    transactions. The first (reward) transaction is never in another node's
+    pool of unconfirmed transactions, so it should always be provided.
     """
-    data = {
-        'block': BlockSerializer(block).data,
+    data = BlockSerializer(block).data
+    data['transaction_hashes'] = [t['hash'] for t in data['transactions']]
+    data['transactions'] = [
+        t for t in data['transactions'] if t['hash'] in transactions
+    ]
+    for t in data['transactions']:
+        t.pop('block')
+    return {
+        'block': data,
         'node': settings.MINER_IP,
     }
-    for node in get_nodes():
-        try:
-            requests.post(f'{node}/p2p/transmit_block/', json=data, timeout=5)
-        except Exception as e:
-            logger.warn(str(e))
-            continue
 
 
 def sync_all():
@@ -70,6 +205,27 @@ def sync_all():
         sync(node)
 
 
+def start_sync(node):
+    """
+    Syncs with the node on a background thread, so that the request that
+    showed we're behind can be answered straight away. Nothing happens if a
+    background sync is already running.
+    """
+    if not background_sync_lock.acquire(blocking=False):
+        return
+    t = threading.Thread(target=_run_background_sync, args=(node,))
+    t.setDaemon(True)
+    t.start()
+
+
+def _run_background_sync(node):
+    try:
+        sync(node)
+    finally:
+        connection.close()
+        background_sync_lock.release()
+
+
 def sync(node):
     """
     Wrapper function around _sync that creates a lock and releases it when
@@ -77,6 +233,7 @@ def sync(node):
     fully up to date with the rest of the network.
     """
     lock = SyncLock.objects.create(node=node)
+    sync_progress.start(node)
 
     try:
         logger.info(f'Starting sync with {node}...')
@@ -94,48 +251,121 @@ def sync(node):
     # Kick off a mine process if all locks are gone and we're due
     if SyncLock.objects.count() == 0 and is_time_to_mine():
         logger.info("All syncs are completed and it's time to mine!")
-        mine_block()
+        request_mining()
 
 
 def _sync(node):
-    # Try to find the most recent overlap, 100 hashes at a time
-    before = None
-    while True:
-        logger.debug(f'Getting blockchain history (before {before})')
-        blockchain_history = get_blockchain_history(node, before=before)
-
-        # Check if we're fully synced (we have the node's active block)
-        latest_block = blockchain_history[0]
-        if before is None and Block.objects.filter(id=latest_block).exists():
-            logger.debug('We are fully synced!')
-            return
-
-        # We aren't synced yet, check if we have any blocks mentioned
-        logger.debug('Searching for common block...')
-        for idx, block in enumerate(blockchain_history):
-            if Block.objects.filter(id=block).exists():
-                # We have this block, so let's add all the ones that come after
-                # Note: They come after this block, but are listed before
-                logger.debug(f'Found common block {block}')
-                return _sync_blocks(node, reversed(blockchain_history[:idx]))
-
-        # We need to go deeper
-        logger.debug('No common blocks found, going deeper...')
-        before = blockchain_history[-1]
-
-
-def _sync_blocks(node, blocks):
-    # Request full block information from the node
-    blocks = list(blocks)
-    logger.debug(f'Downloading block data for {len(blocks)} blocks...')
-    block_data = get_blocks(node, blocks)
-
-    # Process each block
-    with db_transaction.atomic():
-        logger.debug('Processing block data...')
+    # Blocks are downloaded in batches, spread across every node we know
+    # about, while the batches that have already arrived are validated and
+    # committed in chain order
+    peers = [node] + [n for n in get_nodes() if n != node]
+    pending = deque()
+    batch_count = 0
+
+    pool = ThreadPoolExecutor(max_workers=settings.SYNC_DOWNLOAD_WORKERS)
+    try:
+        # Find the most recent block we have in common with the node, and page
+        # through the blocks that follow it
+        base_locator = Block.get_active_block().get_locator()
+        locator = base_locator
+        while True:
+            logger.debug('Locating common block...')
+            history = locate_blocks(node, locator)
+            blocks = history['blocks']
+            sync_progress.update(target_depth=history['active_depth'])
+            logger.debug(f'Found common block {history["common_block"]}')
+
+            # Check if we're fully synced (the node has nothing we don't)
+            if not blocks:
+                break
+
+            # Queue up downloads for the blocks we don't have yet
+            existing = set(Block.objects.filter(
+                id__in=blocks
+            ).values_list('id', flat=True))
+            missing = [b for b in blocks if b not in existing]
+            for batch in chunks(missing, size=settings.SYNC_BATCH_SIZE):
+                peer = peers[batch_count % len(peers)]
+                pending.append(pool.submit(download_blocks, peer, node, batch))
+                batch_count += 1
+
+            # Process batches while the rest are downloading
+            while len(pending) > settings.SYNC_MAX_PENDING_BATCHES:
+                _sync_blocks(pending.popleft().result())
+
+            # Continue from the last block on the page
+            locator = [blocks[-1]] + base_locator
+
+        while pending:
+            _sync_blocks(pending.popleft().result())
+        logger.debug('We are fully synced!')
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+
+def download_blocks(peer, node, blocks):
+    """
+    Downloads data for a batch of blocks (in chain order) from the peer. The
+    peer may not have the blocks if it is behind or on another fork, so we
+    fall back to downloading them from the node we're syncing with.
+    """
+    if peer != node:
+        try:
+            block_data = list(get_blocks(peer, blocks))
+        except Exception as e:
+            logger.debug(f'Failed to download blocks from {peer}: {e}')
+        else:
+            if [b['id'] for b in block_data] == blocks:
+                sync_progress.update(blocks_downloaded=len(blocks))
+                return block_data
+
+    block_data = list(get_blocks(node, blocks))
+    if [b['id'] for b in block_data] != blocks:
+        raise ValueError(f'{node} did not return the requested blocks.')
+    sync_progress.update(blocks_downloaded=len(blocks))
+    return block_data
+
+
+def _sync_blocks(block_data):
+    # Set up the transactions for every block
+    blocks = [data['id'] for data in block_data]
+    block_data = dict(zip(blocks, block_data))
+    block_transactions = {}
+    for block in blocks:
+        transactions = []
+        for t in block_data[block]['transactions']:
+            assert t.pop('block') == block
+            t_serializer = RemoteBlockTransactionSerializer(data=t)
+            t_serializer.is_valid(raise_exception=True)
+            _t = t_serializer.validated_data.copy()
+            if t.get('extra_data'):
+                _t['extra_data'] = b64decode(t['extra_data'])
+            transaction = Transaction(**_t)
+            transactions.append(transaction)
+        block_transactions[block] = transactions
+
+    # Verify every signature up front, so they can be checked in parallel
+    logger.debug('Verifying signatures...')
+    signatures = []
+    for block in blocks:
+        data = block_data[block]
+        signatures.append((block, data['miner'], data['signature']))
+        signatures.extend(get_transaction_signatures(
+            block_transactions[block][1:]
+        ))
+    if not verify_many(signatures):
+        raise ValueError('Block failed signature verification.')
+
+    # Process each block, committing the whole batch at once
+    with atomic_write():
+        logger.debug(f'Processing data for {len(blocks)} blocks...')
+        writer = BlockWriter()
         for block in blocks:
             logger.debug(f'Processing block {block}...')
             data = block_data[block]
+            transactions = block_transactions[block]
 
             # Set up the block
             serializer = BlockSerializer(data=data)
@@ -145,49 +375,44 @@ def _sync_blocks(node, blocks):
                 _block['extra_data'] = b64decode(data['extra_data'])
             block_obj = Block(**_block)
 
-            # Set up the transactions
-            transactions = []
-            for t in data['transactions']:
-                assert t.pop('block') == block_obj.id
-                t_serializer = RemoteBlockTransactionSerializer(data=t)
-                t_serializer.is_valid(raise_exception=True)
-                _t = t_serializer.validated_data.copy()
-                if t.get('extra_data'):
-                    _t['extra_data'] = b64decode(t['extra_data'])
-                transaction = Transaction(**_t)
-                transactions.append(transaction)
-
             # Validate the block and transactions
-            if validate_block(block_obj, transactions):
-                block_obj.save(transactions)
-
-                # Delete any matching unconfirmed transactions
-                UnconfirmedTransaction.objects.filter(
-                    hash__in=(t.hash for t in transactions)
-                ).delete()
+            if validate_block(
+                block_obj,
+                transactions,
+                signatures_verified=True,
+            ):
+                block_obj.save(transactions, writer=writer)
             else:
                 raise ValueError('Block failed validation.')
+        writer.flush()
 
-    # Make sure there aren't any other blocks we need to sync
-    logger.debug('Double checking we are synced...')
-    return _sync(node)
+    sync_progress.update(blocks_processed=len(blocks), batches_committed=1)
 
 
-def get_blockchain_history(node, before=None):
+def locate_blocks(node, locator):
     """
-    Gets a list of block hashes from the specified node.
+    Sends a block locator to the specified node. Returns the most recent
+    block we have in common with the node, the hashes of the blocks that
+    follow it, and the depth of the node's active block.
     """
-    endpoint = f'{node}/p2p/blockchain_history/'
-    if before:
-        endpoint += f'?before={before}'
-    timeout = 10 if not before else 60
-    return requests.get(endpoint, timeout=timeout).json()
+    response = requests.post(f'{node}/p2p/blockchain_history/', json={
+        'locator': locator,
+    }, timeout=60)
+    response.raise_for_status()
+    return response.json()
 
 
 def get_blocks(node, blocks):
     """
-    Gets block data for the specified blocks from the target node.
+    Gets block data for the specified blocks from the target node. Blocks are
+    requested in pages of MAX_BLOCKS_PER_REQUEST, and each block is yielded
+    as soon as it has been received.
     """
-    return requests.post(f'{node}/p2p/blocks/', json={
-        'blocks': blocks,
-    }).json()
+    for page in chunks(blocks, size=settings.MAX_BLOCKS_PER_REQUEST):
+        response = requests.post(f'{node}/p2p/blocks/', json={
+            'blocks': page,
+        }, stream=True, timeout=60)
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
@@ -0,0 +1,206 @@
+import gzip
+import logging
+import os
+
+from django.conf import settings
+from django.db.models import Count
+from rest_framework.renderers import JSONRenderer
+
+from boocoin.models import (
+    AccountTransaction, BalanceChange, BalanceCheckpoint, Block, MerkleTree,
+    Transaction
+)
+from boocoin.serializers import BalanceChangeSerializer, BlockSerializer
+from boocoin.signals import tip_changed
+from boocoin.util.db import atomic_write, chunks
+
+logger = logging.getLogger(__name__)
+
+# The depth of the checkpoint that the chain was last pruned up to
+pruned_depth = None
+
+
+def start_pruning():
+    """
+    Prunes the chain as it grows when running as a pruned node (see
+    settings.PRUNE_KEEP_BLOCKS).
+    """
+    tip_changed.connect(prune_after_checkpoint)
+
+
+def prune_after_checkpoint(block, **kwargs):
+    """
+    Prunes the chain whenever another balances checkpoint falls more than
+    PRUNE_KEEP_BLOCKS blocks below the active block. This is connected to the
+    tip_changed signal.
+    """
+    global pruned_depth
+    interval = settings.BALANCE_CHECKPOINT_INTERVAL
+    depth = block.depth - settings.PRUNE_KEEP_BLOCKS
+    depth -= depth % interval
+    if depth <= 0 or (pruned_depth is not None and depth <= pruned_depth):
+        return
+
+    try:
+        prune_blocks(
+            settings.PRUNE_KEEP_BLOCKS,
+            archive_dir=settings.ARCHIVE_DIR,
+        )
+        pruned_depth = depth
+    except Exception as e:
+        logger.warn(f'Failed to prune blocks: {e}')
+
+
+def find_prune_point(active_block, keep_blocks):
+    """
+    Returns an (id, depth) tuple for the most recent balances checkpoint in
+    the active chain that is at least keep_blocks blocks below the active
+    block, or None if there isn't one.
+    """
+    checkpoints = Block.objects.filter(
+        is_checkpoint=True,
+        depth__gt=0,
+        depth__lte=active_block.depth - keep_blocks,
+    ).order_by('-depth').values_list('id', 'depth')
+    for block_id, depth in checkpoints:
+        if active_block.get_ancestor_id(depth) == block_id:
+            return (block_id, depth)
+    return None
+
+
+def prune_blocks(keep_blocks, archive_dir=None):
+    """
+    Deletes the transactions, merkle trees and balance data of the blocks that
+    are more than keep_blocks blocks below the active block, and marks them
+    as pruned. The blocks themselves and their TransactionIndex rows are kept,
+    so headers can still be served and replayed transactions rejected.
+
+    Pruning stops at a balances checkpoint, so that the balances of every
+    remaining block can still be rebuilt. Blocks on forks that split off
+    below that checkpoint are pruned too, since they could only become active
+    by reorganizing past it.
+
+    If archive_dir is given, the data is exported there first (see
+    archive_blocks). Returns the number of blocks that were pruned.
+    """
+    with atomic_write():
+        active_block = Block.get_active_block()
+        prune_point = find_prune_point(active_block, keep_blocks)
+        if not prune_point:
+            return 0
+
+        checkpoint_id, checkpoint_depth = prune_point
+        descendants = set(Block.get_descendant_ids(checkpoint_id))
+        block_ids = [
+            block_id
+            for block_id, depth in Block.objects.filter(
+                is_pruned=False,
+            ).values_list('id', 'depth')
+            if depth < checkpoint_depth or block_id not in descendants
+        ]
+        if not block_ids:
+            return 0
+
+        if archive_dir:
+            archive_blocks(block_ids, archive_dir)
+
+        for chunk in chunks(block_ids):
+            AccountTransaction.objects.filter(block_id__in=chunk).delete()
+            Transaction.objects.filter(block_id__in=chunk).delete()
+            MerkleTree.objects.filter(block_id__in=chunk).delete()
+            BalanceChange.objects.filter(block_id__in=chunk).delete()
+            BalanceCheckpoint.objects.filter(block_id__in=chunk).delete()
+            Block.objects.filter(id__in=chunk).update(
+                is_pruned=True,
+                is_checkpoint=False,
+            )
+
+    logger.info(f'Pruned {len(block_ids)} blocks.')
+    return len(block_ids)
+
+
+def archive_blocks(block_ids, archive_dir):
+    """
+    Writes the complete data of the given blocks (including their transactions
+    and balance changes) to a gzip compressed segment file in archive_dir.
+    Blocks are written as newline-delimited JSON in chain order, in the same
+    format as the blocks API. Segment files are named after the range of
+    depths they contain. Returns the path of the segment file.
+    """
+    depths = {}
+    for chunk in chunks(block_ids):
+        depths.update(Block.objects.filter(
+            id__in=chunk,
+        ).values_list('id', 'depth'))
+    block_ids = sorted(depths, key=lambda b: (depths[b], b))
+
+    # Never overwrite an earlier segment
+    os.makedirs(archive_dir, exist_ok=True)
+    name = (
+        f'blocks-{depths[block_ids[0]]:010d}-{depths[block_ids[-1]]:010d}'
+    )
+    path = os.path.join(archive_dir, f'{name}.ndjson.gz')
+    n = 1
+    while os.path.exists(path):
+        path = os.path.join(archive_dir, f'{name}-{n}.ndjson.gz')
+        n += 1
+
+    # Write to a temporary file first, so a segment is never left half written
+    renderer = JSONRenderer()
+    with gzip.open(f'{path}.tmp', 'wb') as f:
+        for chunk in chunks(block_ids, size=100):
+            blocks = Block.objects.filter(
+                id__in=chunk
+            ).prefetch_related('transactions', 'balance_changes').in_bulk()
+            for block_id in chunk:
+                block = blocks[block_id]
+                data = BlockSerializer(block).data
+                data['balance_changes'] = BalanceChangeSerializer(
+                    block.balance_changes.all(),
+                    many=True,
+                ).data
+                f.write(renderer.render(data) + b'\n')
+    os.replace(f'{path}.tmp', path)
+
+    logger.info(f'Archived {len(block_ids)} blocks to {path}.')
+    return path
+
+
+def collect_forks(keep_blocks):
+    """
+    Deletes every block on a fork that split off from the active chain more
+    than keep_blocks blocks below the active block, along with everything
+    stored for it. Returns the number of blocks that were deleted.
+    """
+    with atomic_write():
+        active_block = Block.get_active_block()
+        cutoff = active_block.depth - keep_blocks
+        if cutoff <= 0:
+            return 0
+
+        # Every depth with more than one block has a fork. Deleting the first
+        # block of each fork deletes the blocks that follow it too.
+        fork_depths = Block.objects.filter(
+            depth__lte=cutoff,
+        ).values('depth').annotate(
+            count=Count('id'),
+        ).filter(count__gt=1).values_list('depth', flat=True)
+
+        fork_ids = []
+        ancestor = (active_block.id, active_block.depth)
+        for depth in sorted(fork_depths, reverse=True):
+            ancestor = (
+                active_block.get_ancestor_id(depth, start=ancestor),
+                depth,
+            )
+            fork_ids.extend(Block.objects.filter(
+                depth=depth,
+            ).exclude(id=ancestor[0]).values_list('id', flat=True))
+
+        deleted = 0
+        for chunk in chunks(fork_ids):
+            _, counts = Block.objects.filter(id__in=chunk).delete()
+            deleted += counts.get(Block._meta.label, 0)
+
+    logger.info(f'Deleted {deleted} blocks from orphaned forks.')
+    return deleted
@@ -1,6 +1,20 @@
 from rest_framework import serializers
 
-from boocoin.models import Block, Transaction, UnconfirmedTransaction
+from boocoin.models import (
+    AccountState, BalanceChange, Block, Transaction, UnconfirmedTransaction
+)
+
+
+class AccountStateSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = AccountState
+        fields = ('account', 'balance')
+
+
+class BalanceChangeSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = BalanceChange
+        fields = ('account', 'previous_balance', 'balance')
 
 
 class TransactionSerializer(serializers.ModelSerializer):
@@ -21,6 +35,21 @@ class UnconfirmedTransactionSerializer(serializers.ModelSerializer):
         )
 
 
+class RelayedTransactionSerializer(serializers.ModelSerializer):
+    """
+    Validates the fields of transactions relayed in batches. Duplicate hashes
+    are filtered out in bulk, so the per-transaction uniqueness check on the
+    hash is skipped.
+    """
+    class Meta:
+        model = UnconfirmedTransaction
+        fields = (
+            'hash', 'from_account', 'to_account', 'coins', 'extra_data',
+            'time', 'signature'
+        )
+        extra_kwargs = {'hash': {'validators': []}}
+
+
 class RemoteBlockTransactionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Transaction
@@ -33,12 +62,10 @@ class RemoteBlockTransactionSerializer(serializers.ModelSerializer):
 class BlockSerializer(serializers.ModelSerializer):
     transactions = TransactionSerializer(many=True, read_only=True)
 
-    def get_balances(self, instance):
-        return instance.get_balances()
-
     class Meta:
         model = Block
         fields = (
-            'id', 'previous_block', 'depth', 'miner', 'balances',
-            'merkle_root', 'extra_data', 'time', 'signature', 'transactions'
+            'id', 'previous_block', 'depth', 'miner', 'balances_root',
+            'legacy_balances', 'merkle_root', 'extra_data', 'time',
+            'signature', 'transactions'
         )
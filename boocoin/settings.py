@@ -63,13 +63,47 @@ WSGI_APPLICATION = 'boocoin.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
-
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, os.environ.get('DB_NAME', 'db.sqlite3'))
+# SQLite is used by default. Set DB_ENGINE=postgresql (along with DB_NAME,
+# DB_USER, DB_PASSWORD, DB_HOST and DB_PORT) to use PostgreSQL instead.
+# Connections are kept open for DB_CONN_MAX_AGE seconds rather than being
+# opened for every request. Background threads recycle theirs with
+# close_old_connections() before each unit of work, like requests do.
+
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite3')
+
+if DB_ENGINE == 'sqlite3':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, os.environ.get('DB_NAME', 'db.sqlite3')),
+            'OPTIONS': {
+                # Seconds to wait for another connection's write to finish
+                'timeout': 20,
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': f'django.db.backends.{DB_ENGINE}',
+            'NAME': os.environ.get('DB_NAME', 'boocoin'),
+            'USER': os.environ.get('DB_USER', ''),
+            'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+            'HOST': os.environ.get('DB_HOST', ''),
+            'PORT': os.environ.get('DB_PORT', ''),
+        }
     }
-}
+
+DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get('DB_CONN_MAX_AGE', 60))
+
+# PRAGMAs run on every new SQLite connection (see boocoin.util.db). WAL mode
+# lets readers carry on while a block is being written.
+SQLITE_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -65536',
+    'PRAGMA temp_store = MEMORY',
+]
 
 
 # Internationalization
@@ -114,10 +148,130 @@ LOGGING = {
 }
 
 
+# Balances
+# A complete snapshot of balances is stored every BALANCE_CHECKPOINT_INTERVAL
+# blocks. Other blocks only store the balances they changed.
+
+BALANCE_CHECKPOINT_INTERVAL = 100
+
+
+# Pruning
+# Set PRUNE_KEEP_BLOCKS to run as a pruned node, which deletes the
+# transactions and balance data of blocks more than that many blocks below the
+# active block (see boocoin.pruning). If ARCHIVE_DIR is set, that data is
+# first exported there as compressed segment files. The collect_forks command
+# deletes forks that split off more than FORK_KEEP_BLOCKS blocks below the
+# active block.
+
+PRUNE_KEEP_BLOCKS = None
+
+ARCHIVE_DIR = None
+
+FORK_KEEP_BLOCKS = 100
+
+
+# Unconfirmed Transactions
+# At most MEMPOOL_MAX_SIZE unconfirmed transactions are kept in memory. Once
+# the pool is full, the newest transactions are turned away first.
+
+MEMPOOL_MAX_SIZE = 10000
+
+
+# Signature Verification
+# Batches of at least PARALLEL_VERIFICATION_MIN signatures (such as the ones
+# in a block) are verified across SIGNATURE_VERIFICATION_WORKERS processes,
+# falling back to verifying them serially if the processes haven't finished
+# within SIGNATURE_VERIFICATION_TIMEOUT seconds.
+# Up to SIGNATURE_CACHE_SIZE valid signatures are cached so that they are not
+# verified again, and up to PUBLIC_KEY_CACHE_SIZE parsed public keys are
+# cached. The genesis block's miners and any PRECOMPUTED_PUBLIC_KEYS get
+# precomputed tables for faster verification.
+
+SIGNATURE_VERIFICATION_WORKERS = os.cpu_count() or 1
+
+PARALLEL_VERIFICATION_MIN = 32
+
+SIGNATURE_VERIFICATION_TIMEOUT = 60
+
+SIGNATURE_CACHE_SIZE = 100000
+
+PUBLIC_KEY_CACHE_SIZE = 10000
+
+PRECOMPUTED_PUBLIC_KEYS = []
+
+
 # Network Nodes
 
 NODES = []
 
+# The number of block hashes returned by the blockchain history API by
+# default, and the most that can be requested at once
+
+BLOCKCHAIN_HISTORY_PAGE_SIZE = 100
+
+BLOCKCHAIN_HISTORY_MAX_PAGE_SIZE = 500
+
+# The number of transactions returned by the account history API by default,
+# and the most that can be requested at once
+
+ACCOUNT_HISTORY_PAGE_SIZE = 50
+
+ACCOUNT_HISTORY_MAX_PAGE_SIZE = 500
+
+# The most blocks that can be downloaded from a node in one request
+
+MAX_BLOCKS_PER_REQUEST = 100
+
+# Syncing downloads blocks in batches of SYNC_BATCH_SIZE, using up to
+# SYNC_DOWNLOAD_WORKERS concurrent downloads. At most SYNC_MAX_PENDING_BATCHES
+# batches are downloaded ahead of the batch being validated.
+
+SYNC_BATCH_SIZE = 50
+
+SYNC_DOWNLOAD_WORKERS = 4
+
+SYNC_MAX_PENDING_BATCHES = 8
+
+# Transactions and blocks are gossiped to each node in the background. Each
+# node has a queue of up to GOSSIP_QUEUE_SIZE outbound messages, and failed
+# messages are retried GOSSIP_RETRIES times, waiting GOSSIP_RETRY_DELAY
+# seconds before the first retry and doubling the wait after each one.
+
+GOSSIP_QUEUE_SIZE = 1000
+
+GOSSIP_RETRIES = 3
+
+GOSSIP_RETRY_DELAY = 1
+
+GOSSIP_TIMEOUT = 5
+
+# Transactions are relayed in batches of up to GOSSIP_BATCH_SIZE, waiting up
+# to GOSSIP_BATCH_WINDOW seconds for a batch to fill. Nodes accept at most
+# MAX_TRANSACTIONS_PER_REQUEST transactions in a single batch.
+
+GOSSIP_BATCH_SIZE = 500
+
+GOSSIP_BATCH_WINDOW = 0.1
+
+MAX_TRANSACTIONS_PER_REQUEST = 1000
+
+
+# Consensus Parameters
+# These are only used when generating a genesis block, which stores them so
+# that every node agrees on them (see Block.get_consensus_params). A block is
+# mined BLOCK_INTERVAL seconds after the previous one, or as soon as
+# BLOCK_TRANSACTION_THRESHOLD unconfirmed transactions are waiting. Blocks
+# may contain up to MAX_BLOCK_TRANSACTIONS transactions, taking up to
+# MAX_BLOCK_BYTES bytes (set either to None for no limit).
+
+BLOCK_INTERVAL = 600
+
+BLOCK_TRANSACTION_THRESHOLD = 1000
+
+MAX_BLOCK_TRANSACTIONS = 10000
+
+MAX_BLOCK_BYTES = 4000000
+
 
 # Miner Configuration
 
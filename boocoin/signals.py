@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+# Sent with the new block once a new active block has been committed, along
+# with the ids of the blocks that left the active chain (newest first) and
+# joined it (oldest first). See ChainTip.advance.
+tip_changed = Signal()
@@ -1,8 +1,35 @@
+import logging
+import multiprocessing
+import sys
+import threading
 from binascii import hexlify, unhexlify
+from concurrent.futures import (
+    ProcessPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
+)
+from concurrent.futures.process import BrokenProcessPool
 
 from django.conf import settings
 from ecdsa import SigningKey, VerifyingKey, BadSignatureError
 
+from boocoin.util.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+key_cache = None
+key_cache_lock = threading.Lock()
+
+precomputed_keys = {}
+
+signature_cache = None
+signature_cache_lock = threading.Lock()
+
+verification_pool = None
+verification_pool_lock = threading.Lock()
+
+# Set if the verification pool fails, after which signatures are verified
+# serially
+verification_pool_failed = False
+
 
 def key_to_hex(key):
     return hexlify(key.to_string()).decode('utf-8')
@@ -28,11 +55,51 @@ def hex_to_sk(hex_key):
     return SigningKey.from_string(unhex(hex_key))
 
 
+def get_key_cache():
+    """
+    Returns the cache of parsed verifying keys, creating it the first time it
+    is needed. Entries are keyed by the hex public key.
+    """
+    global key_cache
+    with key_cache_lock:
+        if key_cache is None:
+            key_cache = LRUCache(settings.PUBLIC_KEY_CACHE_SIZE)
+        return key_cache
+
+
 def hex_to_pk(public_key):
     """
-    Returns a verifying key from the hex public key.
+    Returns a verifying key from the hex public key. Parsing a key is
+    relatively expensive, so parsed keys are cached.
     """
-    return VerifyingKey.from_string(unhex(public_key))
+    vk = precomputed_keys.get(public_key)
+    if vk is not None:
+        return vk
+
+    cache = get_key_cache()
+    vk = cache.get(public_key)
+    if vk is None:
+        vk = VerifyingKey.from_string(unhex(public_key))
+        cache.set(public_key, vk)
+    return vk
+
+
+def precompute_keys(public_keys):
+    """
+    Builds precomputed multiplication tables for the given hex public keys,
+    which makes verifying their signatures considerably faster. The keys are
+    kept in memory for the life of the process, so this should only be used
+    for keys that sign frequently, like the miners in the genesis block.
+
+    Call this before the verification pool is created, so that its worker
+    processes precompute the same keys.
+    """
+    for public_key in public_keys:
+        if public_key in precomputed_keys:
+            continue
+        vk = VerifyingKey.from_string(unhex(public_key))
+        vk.precompute()
+        precomputed_keys[public_key] = vk
 
 
 def sign(content, sk=None):
@@ -45,10 +112,10 @@ def sign(content, sk=None):
     return hexlify(sk.sign(content.encode('utf-8'))).decode('utf-8')
 
 
-def verify(content, public_key, signature):
+def verify_signature(content, public_key, signature):
     """
     Returns whether or not the signature is valid for the given content and
-    public key.
+    public key. Unlike verify(), this doesn't use the signature cache.
     """
     vk = hex_to_pk(public_key)
     try:
@@ -57,3 +124,159 @@ def verify(content, public_key, signature):
         return False
     except BadSignatureError:
         return False
+
+
+def verify_signatures(signatures):
+    """
+    Accepts a list of (content, public_key, signature) tuples and returns
+    whether or not every signature is valid. Stops at the first failure.
+    Unlike verify_many(), this doesn't use the signature cache.
+    """
+    return all(verify_signature(*s) for s in signatures)
+
+
+def get_signature_cache():
+    """
+    Returns the cache of signatures that have been successfully verified,
+    creating it the first time it is needed. Entries are keyed by a
+    (content, public_key, signature) tuple.
+    """
+    global signature_cache
+    with signature_cache_lock:
+        if signature_cache is None:
+            signature_cache = LRUCache(settings.SIGNATURE_CACHE_SIZE)
+        return signature_cache
+
+
+def verify(content, public_key, signature):
+    """
+    Returns whether or not the signature is valid for the given content and
+    public key. Valid signatures are cached, so a transaction that was
+    verified when it entered the mempool isn't verified again when it is
+    mined or validated as part of a block.
+    """
+    key = (content, public_key, signature)
+    cache = get_signature_cache()
+    if cache.get(key):
+        return True
+
+    if not verify_signature(content, public_key, signature):
+        return False
+    cache.set(key, True)
+    return True
+
+
+def get_verification_pool():
+    """
+    Returns the process pool used to verify signatures in parallel, creating
+    it the first time it is needed.
+
+    Forking a process that is running other threads can leave the workers
+    holding copies of locks that will never be released (like the caches'),
+    so workers are started by a forkserver where possible. Python 3.6 can
+    only fork them, so start_verification_pool() should be called before any
+    other threads are started.
+    """
+    global verification_pool
+    with verification_pool_lock:
+        if verification_pool is None:
+            kwargs = {}
+            if sys.version_info >= (3, 7):
+                kwargs = {
+                    'mp_context': multiprocessing.get_context('forkserver'),
+                    'initializer': precompute_keys,
+                    'initargs': (list(precomputed_keys),),
+                }
+            verification_pool = ProcessPoolExecutor(
+                max_workers=settings.SIGNATURE_VERIFICATION_WORKERS,
+                **kwargs
+            )
+        return verification_pool
+
+
+def start_verification_pool():
+    """
+    Creates the verification pool and waits for every worker process to
+    start. Workers are only started when work is first submitted, so this
+    makes sure that happens now, rather than in the middle of a request.
+    """
+    pool = get_verification_pool()
+    workers = settings.SIGNATURE_VERIFICATION_WORKERS
+    for future in [pool.submit(verify_signatures, []) for _ in range(workers)]:
+        future.result()
+
+
+def verify_in_parallel(signatures):
+    """
+    Accepts a list of (content, public_key, signature) tuples and returns
+    whether or not every signature is valid.
+
+    The signatures are split into chunks that are verified across a pool of
+    processes, since verification is CPU bound. As soon as any chunk reports
+    an invalid signature, the remaining chunks are cancelled.
+
+    If the pool breaks or takes longer than SIGNATURE_VERIFICATION_TIMEOUT
+    seconds, the signatures are verified serially instead, and so is every
+    batch after that.
+    """
+    global verification_pool, verification_pool_failed
+
+    # Use a few chunks per worker so a slow chunk doesn't hold up the rest
+    workers = settings.SIGNATURE_VERIFICATION_WORKERS
+    size = -(-len(signatures) // (workers * 4))
+    pool = get_verification_pool()
+    futures = []
+    try:
+        futures = [
+            pool.submit(verify_signatures, signatures[i:i + size])
+            for i in range(0, len(signatures), size)
+        ]
+        for future in as_completed(
+            futures,
+            timeout=settings.SIGNATURE_VERIFICATION_TIMEOUT,
+        ):
+            if not future.result():
+                return False
+    except (BrokenProcessPool, FuturesTimeoutError) as e:
+        logger.warn(
+            f'Parallel signature verification failed ({e!r}), verifying '
+            f'signatures serially from now on.'
+        )
+        with verification_pool_lock:
+            verification_pool_failed = True
+            verification_pool = None
+        pool.shutdown(wait=False)
+        return verify_signatures(signatures)
+    finally:
+        for future in futures:
+            future.cancel()
+    return True
+
+
+def verify_many(signatures):
+    """
+    Accepts an iterable of (content, public_key, signature) tuples and returns
+    whether or not every signature is valid.
+
+    Signatures that are already in the signature cache are skipped. Large
+    batches of the remaining signatures are verified in parallel.
+    """
+    cache = get_signature_cache()
+    signatures = [tuple(s) for s in signatures if not cache.get(tuple(s))]
+    if not signatures:
+        return True
+
+    workers = settings.SIGNATURE_VERIFICATION_WORKERS
+    if (
+        workers < 2 or
+        verification_pool_failed or
+        len(signatures) < settings.PARALLEL_VERIFICATION_MIN
+    ):
+        valid = verify_signatures(signatures)
+    else:
+        valid = verify_in_parallel(signatures)
+
+    if valid:
+        for key in signatures:
+            cache.set(key, True)
+    return valid
@@ -1,36 +1,64 @@
 import logging
 import threading
-import time
 
+from django.db import close_old_connections
 from django.utils.timezone import now
 
-from boocoin.mining import mine_block
+from boocoin.mining import request_mining
 from boocoin.models import Block
+from boocoin.signals import tip_changed
 
 logger = logging.getLogger(__name__)
 
+# How long to wait before asking to mine again if the last request didn't
+# produce a block (for example, because we were syncing), or before checking
+# again if the check failed
+RETRY_SECONDS = 30
+
+# Set whenever the active block changes, so the timer recalculates when the
+# next block is due
+rearm = threading.Event()
+
 
 def start_waiting_for_blocks():
+    tip_changed.connect(rearm_timer)
     t = threading.Thread(target=wait_for_blocks)
     t.setDaemon(True)
     t.start()
 
 
+def rearm_timer(**kwargs):
+    rearm.set()
+
+
 def wait_for_blocks():
     while True:
-        check_for_block()
-        time.sleep(30)
+        rearm.clear()
+        close_old_connections()
+        try:
+            timeout = check_for_block()
+        except Exception as e:
+            logger.warn(f'Failed to check for a block: {e}')
+            timeout = RETRY_SECONDS
+        rearm.wait(timeout)
 
 
 def check_for_block():
+    """
+    Asks to mine a new block if one is due. Returns how many seconds to wait
+    before checking again, unless the active block changes first.
+    """
     # Get the active block
     active_block = Block.get_active_block()
 
-    # Calculate how many minutes it has been since that block
-    minutes_passed = (now() - active_block.time).total_seconds() / 60
-    logger.debug(f'Minutes passed since last block: {minutes_passed}')
+    # Calculate how long it has been since that block
+    seconds_passed = (now() - active_block.time).total_seconds()
+    logger.debug(f'Seconds passed since last block: {seconds_passed}')
 
-    # Mine a new block if it has been 10 minutes
-    if minutes_passed >= 10:
-        logger.info('10 minutes passed, mining new block...')
-        mine_block()
+    # Mine a new block if it has been long enough
+    block_interval = Block.get_consensus_params()['block_interval']
+    if seconds_passed >= block_interval:
+        logger.info(f'{block_interval} seconds passed, mining new block...')
+        request_mining()
+        return RETRY_SECONDS
+    return block_interval - seconds_passed
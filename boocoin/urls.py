@@ -5,13 +5,35 @@ from boocoin import views
 urlpatterns = [
     # User APIs
     path('api/block_count/', views.BlockCountView.as_view()),
+    path('api/sync_status/', views.SyncStatusView.as_view()),
     path('api/block/<slug:id>/', views.BlockView.as_view()),
     path('api/transaction/<slug:hash>/', views.TransactionView.as_view()),
+    path(
+        'api/transaction/<slug:hash>/proof/',
+        views.TransactionProofView.as_view(),
+    ),
+    path(
+        'api/account/<slug:key>/balance/',
+        views.AccountBalanceView.as_view(),
+    ),
+    path(
+        'api/account/<slug:key>/transactions/',
+        views.AccountTransactionsView.as_view(),
+    ),
     path('api/submit_transaction/', views.SubmitTransactionView.as_view()),
 
     # "Peer-to-peer" APIs
     path('p2p/transmit_transaction/', views.TransmitTransactionView.as_view()),
+    path(
+        'p2p/transmit_transactions/',
+        views.TransmitTransactionsView.as_view(),
+    ),
     path('p2p/transmit_block/', views.TransmitBlockView.as_view()),
+    path(
+        'p2p/transmit_compact_block/',
+        views.TransmitCompactBlockView.as_view(),
+    ),
+    path('p2p/inventory/', views.InventoryView.as_view()),
     path('p2p/blockchain_history/', views.BlockchainHistoryView.as_view()),
     path('p2p/blocks/', views.BlocksView.as_view()),
 ]
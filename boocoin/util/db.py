@@ -1,4 +1,44 @@
-from django.db import connections
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections, transaction
+
+# SQLite only allows one writer at a time, and a transaction that has already
+# read fails immediately (rather than waiting) if another connection starts
+# writing. Transactions that write to the chain, along with background
+# writers, hold this lock so that they take turns instead.
+write_lock = threading.RLock()
+
+
+@contextmanager
+def atomic_write(using=None):
+    """
+    Runs the enclosed code in a database transaction while holding the write
+    lock. Like transaction.atomic, this can also be used as a decorator.
+    """
+    with write_lock, transaction.atomic(using=using):
+        yield
+
+
+def configure_connection(sender, connection, **kwargs):
+    """
+    Tunes new SQLite connections with settings.SQLITE_PRAGMAS. This is
+    connected to the connection_created signal.
+    """
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            for pragma in settings.SQLITE_PRAGMAS:
+                cursor.execute(pragma)
+
+
+def chunks(items, size=500):
+    """
+    Splits an iterable into lists of at most the given size. This keeps
+    queries with large IN clauses under the database's parameter limit.
+    """
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
 
 
 def query_cursor(query_string, *query_args, database='default', cursor=None, **query_kwargs):
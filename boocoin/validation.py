@@ -1,46 +1,108 @@
-import json
 import logging
+import simplejson as json
 
 from django.utils.timezone import now
 
-from boocoin.balances import apply_transaction_to_balances, InsufficientFunds
+from boocoin.balances import (
+    BalanceOverlay, check_funds, get_transaction_accounts, InsufficientFunds
+)
 from boocoin.hashing import calculate_merkle_root
+from boocoin.mempool import get_mempool
 from boocoin.models import Block
-from boocoin.signing import verify
+from boocoin.signing import verify, verify_many
 
 logger = logging.getLogger(__name__)
 
 
-def prune_invalid_transactions(previous_block, transactions):
+def prune_invalid_transactions(previous_block, transactions,
+                               max_transactions=None, max_bytes=None):
     """
-    Deletes any transactions that would not pass validation.
-    Returns the transactions that passed.
+    Removes any transactions that would not pass validation from the pool of
+    unconfirmed transactions. Returns the transactions that passed, up to
+    max_transactions transactions and max_bytes bytes (see
+    TransactionHashMixin.get_size). Transactions that don't fit are left in
+    the pool for a later block.
     """
     logger.debug('Pruning invalid transactions...')
     approved_transactions = []
-
-    # Start with the current balancess
-    balances = previous_block.get_balances()
+    invalid_transactions = []
+    size = 0
+    transactions = list(transactions)
+
+    # Start with the current balances of the accounts involved
+    balances = BalanceOverlay(previous_block.get_balances(
+        get_transaction_accounts(transactions)
+    ))
+
+    # Look for replayed transactions all at once
+    replayed = previous_block.find_transactions_in_chain(
+        t.hash for t in transactions
+    )
 
     for transaction in transactions:
-        if not validate_transaction(
+        # Stop once the block is full
+        if (
+            max_transactions is not None and
+            len(approved_transactions) >= max_transactions
+        ):
+            break
+
+        if transaction.hash in replayed or not validate_transaction(
             balances,
             transaction,
             prev_block=previous_block,
-            first_in_block=False
+            first_in_block=False,
+            check_chain=False,
         ):
-            # Invalid transaction, delete it and move on
+            # Invalid transaction, remove it and move on
             logger.debug(f'Transaction {transaction.hash} invalid, pruning...')
-            transaction.delete()
+            invalid_transactions.append(transaction.hash)
             continue
         else:
+            # Skip the transaction if it doesn't fit, since a smaller one
+            # still might
+            transaction_size = transaction.get_size()
+            if max_bytes is not None and size + transaction_size > max_bytes:
+                continue
+
             # Transaction passed, add it and update balances
+            size += transaction_size
             approved_transactions.append(transaction)
-            balances = apply_transaction_to_balances(transaction, balances)
+            balances.apply(transaction)
+            balances.commit()
 
+    get_mempool().remove(invalid_transactions)
     return approved_transactions
 
 
+def validate_unconfirmed_transactions(transactions, active_block):
+    """
+    Returns the unconfirmed transactions that would pass validation on top of
+    the active block, in their original order. Their signatures must already
+    have been verified (see verify_many). Replayed transactions are looked up
+    all at once, and funds are checked against what each sender has left to
+    spend in the pool (see Mempool.get_available_balances).
+    """
+    transactions = list(transactions)
+    replayed = active_block.find_transactions_in_chain(
+        t.hash for t in transactions
+    )
+    balances = get_mempool().get_available_balances(
+        {t.from_account for t in transactions if t.from_account},
+        active_block,
+    )
+    return [
+        t for t in transactions
+        if t.hash not in replayed and validate_transaction(
+            balances,
+            t,
+            prev_block=active_block,
+            check_chain=False,
+            check_signature=False,
+        )
+    ]
+
+
 def tinvalid(reason):
     logger.debug(f'Transaction is invalid: {reason}')
     return False
@@ -51,8 +113,31 @@ def binvalid(reason):
     return False
 
 
+def get_signatures(block, transactions):
+    """
+    Returns a list of (content, public_key, signature) tuples for the block
+    and every transaction in it that is signed by a sender.
+    """
+    signatures = [(block.id, block.miner, block.signature)]
+    signatures.extend(get_transaction_signatures(transactions[1:]))
+    return signatures
+
+
+def get_transaction_signatures(transactions):
+    """
+    Returns a list of (content, public_key, signature) tuples for every
+    transaction that is signed by a sender.
+    """
+    return [
+        (t.hash, t.from_account, t.signature)
+        for t in transactions
+        if t.from_account
+    ]
+
+
 def validate_transaction(balances, transaction, prev_block,
-                         first_in_block=False):
+                         first_in_block=False, check_chain=True,
+                         check_signature=True):
     logger.debug(f'Validating transaction {transaction.hash}')
 
     # Verify the transaction hash
@@ -86,8 +171,9 @@ def validate_transaction(balances, transaction, prev_block,
         if transaction.from_account == transaction.to_account:
             return tinvalid('from_account should not equal to_account')
 
-        # Verify the sender's signature
-        valid_signature = verify(
+        # Verify the sender's signature (blocks verify all of their
+        # signatures at once, so they can skip this)
+        valid_signature = not check_signature or verify(
             content=transaction.hash,
             public_key=transaction.from_account,
             signature=transaction.signature,
@@ -101,20 +187,47 @@ def validate_transaction(balances, transaction, prev_block,
 
     # Check for sufficient funds
     try:
-        balances = apply_transaction_to_balances(transaction, balances)
+        check_funds(transaction, balances)
     except InsufficientFunds:
         return tinvalid('Insufficient funds')
 
     # Ensure the transaction hasn't already been included in this chain
-    # This prevents replay attacks
-    if prev_block.has_transaction_in_chain(transaction.hash):
+    # This prevents replay attacks (blocks check all of their transactions
+    # at once, so they can skip this)
+    if check_chain and prev_block.has_transaction_in_chain(transaction.hash):
         return tinvalid('Already exists in chain, rejecting replay attack')
 
     logger.debug('Transaction validated')
     return True
 
 
-def validate_block(block, transactions):
+def validate_legacy_balances(block, previous_block):
+    """
+    Returns whether or not a block is allowed to have legacy balances (see
+    Block.legacy_balances), and they match its balances. Only chains from
+    before balance changes were stored can have them, and only in an unbroken
+    run of blocks that follows the genesis block.
+    """
+    if (
+        Block.get_encoding_version() != 0 or
+        previous_block.legacy_balances is None
+    ):
+        return False
+
+    try:
+        legacy_balances = json.loads(block.legacy_balances, use_decimal=True)
+    except ValueError:
+        return False
+
+    balances = previous_block.get_balances()
+    balances.update(
+        (change.account, change.balance)
+        for change in block.pending_balance_changes
+    )
+    return legacy_balances == balances
+
+
+def validate_block(block, transactions, signatures_verified=False):
     logger.debug(f'Validating block {block.id}')
 
     # Verify the block hash
@@ -127,6 +240,10 @@ def validate_block(block, transactions):
     except Block.DoesNotExist:
         return binvalid('Previous block does not exist')
 
+    # The balances of pruned blocks can't be rebuilt (see boocoin.pruning)
+    if previous_block.is_pruned:
+        return binvalid('Previous block has been pruned')
+
     # Verify the depth of the block
     if block.depth != previous_block.depth + 1:
         return binvalid('Depth is incorrect')
@@ -135,45 +252,86 @@ def validate_block(block, transactions):
     if block.time > now():
         return binvalid('Time is in the future')
 
-    # Verify the block has 11 transactions (10 + 1) or it has been 10 minutes
-    minutes_passed = (block.time - previous_block.time).total_seconds() / 60
-    if len(transactions) < 11 and minutes_passed < 10:
-        return binvalid('Transaction count and minutes passed are wrong')
+    # Verify the block has enough transactions (plus the block reward) or
+    # enough time has passed
+    params = Block.get_consensus_params()
+    seconds_passed = (block.time - previous_block.time).total_seconds()
+    if (
+        len(transactions) < params['transaction_threshold'] + 1 and
+        seconds_passed < params['block_interval']
+    ):
+        return binvalid('Transaction count and seconds passed are wrong')
+
+    # Verify the block is within the size limits
+    max_transactions = params['max_block_transactions']
+    if max_transactions is not None and len(transactions) > max_transactions:
+        return binvalid('Too many transactions')
+    max_bytes = params['max_block_bytes']
+    if (
+        max_bytes is not None and
+        sum(t.get_size() for t in transactions) > max_bytes
+    ):
+        return binvalid('Transactions are too large')
 
     # A miner must be set
     if not block.miner:
         return binvalid('Missing miner')
 
     # The miner must be in the genesis block
-    genesis_block = Block.get_genesis_block()
-    miners = json.loads(genesis_block.extra_data.decode('utf-8'))
-    if block.miner not in miners:
+    if block.miner not in Block.get_authorized_miners():
         return binvalid('Miner not in genesis block')
 
-    # Verify the miner's signature
-    valid_signature = verify(
-        content=block.id,
-        public_key=block.miner,
-        signature=block.signature,
-    )
-    if not valid_signature:
-        return binvalid('Bad signature')
+    # Verify the miner's signature along with every transaction's signature,
+    # unless the caller has already verified them with verify_many()
+    if not signatures_verified:
+        if not verify_many(get_signatures(block, transactions)):
+            return binvalid('Bad signature')
 
     # Verify merkle root
     expected_merkle_root = calculate_merkle_root(t.hash for t in transactions)
     if expected_merkle_root != block.merkle_root:
         return binvalid('Bad merkle root')
 
+    # Ensure no transaction appears twice in the block, or has already been
+    # included in this chain. This prevents replay attacks.
+    tx_hashes = [t.hash for t in transactions]
+    if len(set(tx_hashes)) != len(tx_hashes):
+        return binvalid('Duplicate transaction detected')
+    if previous_block.find_transactions_in_chain(tx_hashes):
+        return binvalid('Transaction already exists in chain')
+
     # Verify balances
-    balances = previous_block.get_balances()
+    balances = previous_block.get_balances(
+        get_transaction_accounts(transactions)
+    )
+    overlay = BalanceOverlay(balances)
     for idx, transaction in enumerate(transactions):
         if not validate_transaction(
-            balances,
+            overlay,
             transaction,
             prev_block=previous_block,
-            first_in_block=(idx == 0)
+            first_in_block=(idx == 0),
+            check_chain=False,
+            check_signature=False,
         ):
             return binvalid('Invalid transaction detected')
+        overlay.apply(transaction)
+        overlay.commit()
+
+    # Verify the balances root. The verified changes are kept so the block
+    # can be saved without replaying its transactions.
+    balances_root = block.balances_root
+    block.set_balance_changes(balances, overlay.changes)
+    if block.balances_root != balances_root:
+        return binvalid('Bad balances root')
+
+    # Blocks from before balance changes were stored are hashed with the
+    # complete balances instead, so those have to match as well
+    if (
+        block.legacy_balances is not None and
+        not validate_legacy_balances(block, previous_block)
+    ):
+        return binvalid('Bad legacy balances')
 
     # All checks passed, the block is valid
     logger.debug('Block validated')
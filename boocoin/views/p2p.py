@@ -1,48 +1,225 @@
 import logging
+import re
 from base64 import b64decode
 
-from django.db import transaction
+from django.conf import settings
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
-from boocoin.mining import mine_block
+from boocoin.mempool import get_mempool
+from boocoin.mining import is_transaction_threshold_met, request_mining
 from boocoin.models import Block, Transaction, UnconfirmedTransaction
-from boocoin.p2p import normalize_node, get_nodes, sync
+from boocoin.p2p import normalize_node, get_nodes, start_sync
 from boocoin.serializers import (
-    BlockSerializer, UnconfirmedTransactionSerializer,
+    BlockSerializer, RelayedTransactionSerializer,
     RemoteBlockTransactionSerializer
 )
+from boocoin.signing import verify, verify_many
+from boocoin.util.db import atomic_write, chunks
 from boocoin.util.views import APIView
-from boocoin.validation import validate_block
+from boocoin.validation import (
+    validate_block, validate_unconfirmed_transactions
+)
 
 logger = logging.getLogger(__name__)
 
+# Locators grow logarithmically, so this covers any realistic chain
+MAX_LOCATOR_SIZE = 100
+
+# The number of blocks loaded into memory at once when streaming blocks
+STREAM_CHUNK_SIZE = 20
+
+HASH_PATTERN = re.compile('[0-9a-f]{64}')
+
 
 class TransmitTransactionView(APIView):
     """
     Ingests unconfirmed transactions from remote nodes.
     """
 
-    @transaction.atomic
     def post(self, request):
-        transaction = UnconfirmedTransactionSerializer(data=request.data)
-        transaction.is_valid(raise_exception=True)
-        transaction.save()
+        serializer = RelayedTransactionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        mempool = get_mempool()
+        if serializer.validated_data['hash'] in mempool:
+            return Response(status=400)
+        _t = serializer.validated_data.copy()
+        if request.data.get('extra_data'):
+            _t['extra_data'] = b64decode(request.data['extra_data'])
+        tx = UnconfirmedTransaction(**_t)
 
-        # Mine a block if we have at least 10 transaction waiting
-        if UnconfirmedTransaction.objects.count() >= 10:
-            logger.info('At least 10 transactions waiting, mining new block.')
-            mine_block()
+        # Verify the sender's signature, then the rest of the transaction
+        if not verify_many([(tx.hash, tx.from_account, tx.signature)]):
+            return Response(status=400)
+        active_block = Block.get_active_block()
+        if not validate_unconfirmed_transactions([tx], active_block):
+            return Response(status=400)
+
+        mempool.add(tx, active_block)
+
+        # Mine a block if enough transactions are waiting
+        if is_transaction_threshold_met():
+            logger.info('Enough transactions waiting, mining new block.')
+            request_mining()
 
         return Response()
 
 
+class TransmitTransactionsView(APIView):
+    """
+    Ingests a batch of unconfirmed transactions from a remote node. Invalid
+    transactions and ones we already have are skipped, and the rest are
+    added to the pool all at once.
+    """
+
+    def post(self, request):
+        data = request.data.get('transactions')
+        if (
+            not isinstance(data, list) or
+            len(data) > settings.MAX_TRANSACTIONS_PER_REQUEST
+        ):
+            return Response(status=400)
+
+        # Validate the fields of each transaction, dropping any duplicates
+        transactions = {}
+        for t in data:
+            serializer = RelayedTransactionSerializer(data=t)
+            if not serializer.is_valid():
+                continue
+            _t = serializer.validated_data.copy()
+            if t.get('extra_data'):
+                _t['extra_data'] = b64decode(t['extra_data'])
+            tx = UnconfirmedTransaction(**_t)
+            transactions[tx.hash] = tx
+
+        # Skip transactions we already have
+        mempool = get_mempool()
+        transactions = [
+            t for t in transactions.values() if t.hash not in mempool
+        ]
+
+        # Verify every signature at once, only checking them individually if
+        # the batch contains a bad one
+        signatures = [
+            (t.hash, t.from_account, t.signature) for t in transactions
+        ]
+        if not verify_many(signatures):
+            transactions = [
+                t for t in transactions
+                if verify(t.hash, t.from_account, t.signature)
+            ]
+
+        # Validate everything else about the transactions, checking for
+        # replays all at once
+        active_block = Block.get_active_block()
+        transactions = validate_unconfirmed_transactions(
+            transactions,
+            active_block,
+        )
+
+        mempool.add_many(transactions, active_block)
+
+        # Mine a block if enough transactions are waiting
+        if is_transaction_threshold_met():
+            logger.info('Enough transactions waiting, mining new block.')
+            request_mining()
+
+        return Response()
+
+
+def parse_block(data):
+    """
+    Builds a Block from block data sent by a remote node.
+    """
+    serializer = BlockSerializer(data=data)
+    serializer.is_valid(raise_exception=True)
+    _block = serializer.validated_data.copy()
+    if data.get('extra_data'):
+        _block['extra_data'] = b64decode(data['extra_data'])
+    return Block(**_block)
+
+
+def parse_transaction(block, data):
+    """
+    Builds a Transaction in the given block from transaction data sent by a
+    remote node.
+    """
+    if 'block' in data:
+        assert data.pop('block') == block.id
+    serializer = RemoteBlockTransactionSerializer(data=data)
+    serializer.is_valid(raise_exception=True)
+    _t = serializer.validated_data.copy()
+    if data.get('extra_data'):
+        _t['extra_data'] = b64decode(data['extra_data'])
+    return Transaction(**_t)
+
+
+def is_hash(value):
+    """
+    Returns whether or not the value is a hex SHA3-256 hash.
+    """
+    return isinstance(value, str) and bool(HASH_PATTERN.fullmatch(value))
+
+
+def ingest_block(node, block, transactions):
+    """
+    Validates and saves a block received from a remote node. Returns the
+    response for the node.
+    """
+    with atomic_write():
+        if validate_block(block, transactions):
+            # Matching unconfirmed transactions are removed if the block joins
+            # the active chain (see boocoin.mempool.follow_chain_tip)
+            block.save(transactions)
+            return Response()
+
+    logger.debug(f'Rejecting block from {node}')
+    return Response(status=400)
+
+
+class InventoryView(APIView):
+    """
+    Receives the hashes of transactions and blocks that a remote node has,
+    and responds with the ones we don't have yet. The node then sends us
+    those (see boocoin.p2p.broadcast_transaction and broadcast_block).
+    """
+
+    def post(self, request):
+        transactions = request.data.get('transactions', [])
+        blocks = request.data.get('blocks', [])
+        if (
+            not isinstance(transactions, list) or
+            not isinstance(blocks, list) or
+            len(transactions) + len(blocks) >
+            settings.MAX_TRANSACTIONS_PER_REQUEST or
+            not all(map(is_hash, transactions + blocks))
+        ):
+            return Response(status=400)
+
+        # Look for transactions we're waiting to mine, or already have mined
+        mempool = get_mempool()
+        known = {t for t in transactions if t in mempool}
+        known |= Block.get_active_block().find_transactions_in_chain(
+            t for t in transactions if t not in known
+        )
+        known |= set(Block.objects.filter(
+            id__in=blocks
+        ).values_list('id', flat=True))
+
+        return Response({
+            'transactions': [t for t in transactions if t not in known],
+            'blocks': [b for b in blocks if b not in known],
+        })
+
+
 class TransmitBlockView(APIView):
     """
     Ingests blocks from remote nodes.
     """
 
-    @transaction.atomic
     def post(self, request):
         block = request.data.get('block')
         node = normalize_node(request.data.get('node'))
@@ -59,51 +236,101 @@ class TransmitBlockView(APIView):
             logger.debug(
                 f'We do not have block {block["previous_block"]}, syncing...'
             )
-            sync(node)
+            start_sync(node)
             return Response()
 
-        # Set up the block
-        serializer = BlockSerializer(data=block)
-        serializer.is_valid(raise_exception=True)
-        _block = serializer.validated_data.copy()
-        if block.get('extra_data'):
-            _block['extra_data'] = b64decode(block['extra_data'])
-        block_obj = Block(**_block)
+        # Set up the block and transactions
+        block_obj = parse_block(block)
+        transactions = [
+            parse_transaction(block_obj, t) for t in block['transactions']
+        ]
 
-        # Set up the transactions
-        transactions = []
-        for t in block['transactions']:
-            assert t.pop('block') == block_obj.id
-            t_serializer = RemoteBlockTransactionSerializer(data=t)
-            t_serializer.is_valid(raise_exception=True)
-            _t = t_serializer.validated_data.copy()
-            if t.get('extra_data'):
-                _t['extra_data'] = b64decode(t['extra_data'])
-            transaction = Transaction(**_t)
-            transactions.append(transaction)
+        return ingest_block(node, block_obj, transactions)
 
-        # Validate the block and transactions
-        if validate_block(block_obj, transactions):
-            block_obj.save(transactions)
 
-            # Delete any matching unconfirmed transactions
-            UnconfirmedTransaction.objects.filter(
-                hash__in=(t.hash for t in transactions)
-            ).delete()
+class TransmitCompactBlockView(APIView):
+    """
+    Ingests compact blocks from remote nodes. Compact blocks list the hashes
+    of all of their transactions, but only include the data for some of them.
+    The rest are rebuilt from our unconfirmed transactions. If we don't have
+    all of them, the response lists the missing hashes so that the node can
+    send the block again with those transactions included.
+    """
 
-            return Response()
-        else:
-            logger.debug(f'Rejecting block from {node}')
+    def post(self, request):
+        block = request.data.get('block')
+        node = normalize_node(request.data.get('node'))
+        nodes = get_nodes()
+        if node not in nodes:
             return Response(status=400)
 
+        logger.debug(
+            f'Processing compact block {block["id"]} from node {node}...'
+        )
+
+        # Check if we already have the block
+        if Block.objects.filter(id=block['id']).exists():
+            return Response()
+
+        # Check if we have the previous block this block refers to
+        if not Block.objects.filter(id=block['previous_block']).exists():
+            logger.debug(
+                f'We do not have block {block["previous_block"]}, syncing...'
+            )
+            start_sync(node)
+            return Response()
+
+        # Find the transactions we need to rebuild the block
+        block_obj = parse_block(block)
+        hashes = block['transaction_hashes']
+        included = {t['hash']: t for t in block['transactions']}
+        mempool = get_mempool()
+        unconfirmed = {}
+        missing = []
+        for h in hashes:
+            if h not in included:
+                tx = mempool.get(h)
+                if tx:
+                    unconfirmed[h] = tx
+                else:
+                    missing.append(h)
+        if missing:
+            logger.debug(f'Requesting {len(missing)} missing transactions')
+            return Response({'missing': missing})
+
+        # Set up the transactions
+        transactions = []
+        for h in hashes:
+            if h in included:
+                transactions.append(parse_transaction(block_obj, included[h]))
+            else:
+                transactions.append(unconfirmed[h].to_transaction())
+
+        return ingest_block(node, block_obj, transactions)
+
 
 class BlockchainHistoryView(APIView):
     """
     Returns a list of the last 100 block hashes from the most recent node (or
     the specified node). This is used by nodes during the sync process to
     find a common block to start downloading data from.
+
+    The number of hashes can be changed with the count parameter, up to
+    BLOCKCHAIN_HISTORY_MAX_PAGE_SIZE.
+
+    Nodes can also POST a block locator (see Block.get_locator) to find the
+    most recent block they have in common with this node in one request. The
+    response contains that block's hash, the hashes of the blocks that follow
+    it in our active chain (oldest first), and the depth of our active block.
     """
 
+    def get_count(self, request):
+        count = request.GET.get('count')
+        if count and not count.isdigit():
+            raise ValidationError({'count': 'Invalid count.'})
+        count = int(count) if count else settings.BLOCKCHAIN_HISTORY_PAGE_SIZE
+        return max(1, min(count, settings.BLOCKCHAIN_HISTORY_MAX_PAGE_SIZE))
+
     def get(self, request):
         before = request.GET.get('before')
         if before:
@@ -111,24 +338,68 @@ class BlockchainHistoryView(APIView):
         else:
             from_block = Block.get_active_block()
 
-        ids = []
-        for i in range(100):
-            ids.append(from_block.id)
-            if from_block.previous_block:
-                from_block = from_block.previous_block
-            else:
-                break
+        return Response(from_block.get_ancestor_ids(self.get_count(request)))
 
-        return Response(ids)
+    def post(self, request):
+        locator = request.data.get('locator') or []
+        active_block = Block.get_active_block()
+        common_block = active_block.find_common_block(
+            locator[:MAX_LOCATOR_SIZE]
+        )
+        if not common_block:
+            return Response(status=404)
+
+        # Find the blocks that follow the common block, newest first
+        common_block_id, depth = common_block
+        last_depth = min(depth + self.get_count(request), active_block.depth)
+        blocks = []
+        if last_depth > depth:
+            ancestry = Block.get_ancestry(
+                active_block.get_ancestor_id(last_depth),
+                count=last_depth - depth,
+            )
+            blocks = [block_id for block_id, _ in ancestry]
+
+        return Response({
+            'common_block': common_block_id,
+            'blocks': list(reversed(blocks)),
+            'active_depth': active_block.depth,
+        })
 
 
 class BlocksView(APIView):
     """
     Returns complete data (including transactions) for the specified block
-    hashes.
+    hashes. Blocks are streamed as newline-delimited JSON, one block per line
+    in chain order, so that large downloads don't need to be held in memory.
+
+    At most MAX_BLOCKS_PER_REQUEST blocks are returned per request. Any
+    additional hashes are ignored, so larger downloads should be split into
+    multiple requests. Pruned blocks are left out, since their transactions
+    are gone.
     """
 
     def post(self, request):
-        block_ids = request.data.get('blocks')
-        blocks = Block.objects.filter(id__in=block_ids)
-        return Response({b.id: BlockSerializer(b).data for b in blocks})
+        block_ids = request.data.get('blocks') or []
+        block_ids = block_ids[:settings.MAX_BLOCKS_PER_REQUEST]
+        return StreamingHttpResponse(
+            self.stream_blocks(block_ids),
+            content_type='application/x-ndjson',
+        )
+
+    def stream_blocks(self, block_ids):
+        # Put the blocks in chain order without loading them
+        block_ids = list(Block.objects.filter(
+            id__in=block_ids,
+            is_pruned=False,
+        ).order_by('depth', 'id').values_list('id', flat=True))
+
+        # Load the blocks (and their transactions) a few at a time
+        renderer = JSONRenderer()
+        for chunk in chunks(block_ids, size=STREAM_CHUNK_SIZE):
+            blocks = Block.objects.filter(
+                id__in=chunk
+            ).prefetch_related('transactions').in_bulk()
+            for block_id in chunk:
+                data = BlockSerializer(blocks[block_id]).data
+                yield renderer.render(data) + b'\n'
@@ -1,9 +1,18 @@
+from django.conf import settings
+from django.db.models import Subquery
+from django.http import Http404
 from django.shortcuts import get_object_or_404, get_list_or_404
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 
 from boocoin import forms
-from boocoin.models import Block, Transaction
-from boocoin.serializers import BlockSerializer, TransactionSerializer
+from boocoin.models import (
+    AccountState, AccountTransaction, Block, ChainTip, MerkleTree, Transaction
+)
+from boocoin.p2p import sync_progress
+from boocoin.serializers import (
+    AccountStateSerializer, BlockSerializer, TransactionSerializer
+)
 from boocoin.util.forms import FormView
 from boocoin.util.views import APIView
 
@@ -14,7 +23,17 @@ class BlockCountView(APIView):
     """
 
     def get(self, request):
-        return Response(Block.get_active_block().depth + 1)
+        return Response(ChainTip.get().depth + 1)
+
+
+class SyncStatusView(APIView):
+    """
+    Returns the progress of the current (or most recent) sync with another
+    node.
+    """
+
+    def get(self, request):
+        return Response(sync_progress.to_dict())
 
 
 class BlockView(APIView):
@@ -40,6 +59,106 @@ class TransactionView(APIView):
             return Response(TransactionSerializer(transaction).data, many=True)
 
 
+class TransactionProofView(APIView):
+    """
+    Returns a proof that a transaction is in the longest chain. Clients can
+    check the proof against the merkle root of the block it is in (see
+    boocoin.hashing.verify_merkle_proof) without downloading the block.
+    """
+
+    def get(self, request, hash):
+        block_id = Block.get_active_block().find_transaction_block(hash)
+        if not block_id:
+            raise Http404
+        tree = get_object_or_404(
+            MerkleTree.objects.select_related('block'),
+            block_id=block_id,
+        )
+        result = tree.get_proof(hash)
+        if result is None:
+            raise Http404
+        index, proof = result
+        return Response({
+            'transaction': hash,
+            'block': block_id,
+            'merkle_root': tree.block.merkle_root,
+            'index': index,
+            'proof': proof,
+        })
+
+
+class AccountBalanceView(APIView):
+    """
+    Returns an account's balance as of the active block, along with the hash
+    and depth of that block. Accounts that have never been used have a
+    balance of 0.
+    """
+
+    def get(self, request, key):
+        # Read the tip and the balance in a single query, so that they always
+        # come from the same snapshot (a transaction alone wouldn't guarantee
+        # that under READ COMMITTED)
+        balance = AccountState.objects.filter(account=key).values('balance')
+        tips = ChainTip.objects.filter(pk=1).annotate(balance=Subquery(
+            balance[:1],
+            output_field=AccountState._meta.get_field('balance'),
+        )).values('block_id', 'depth', 'balance')
+        tip = tips.first()
+        if tip is None:
+            # Record the chain tip for the first time, then try again
+            ChainTip.get()
+            tip = tips.first()
+
+        state = AccountState(account=key, balance=tip['balance'] or 0)
+        data = AccountStateSerializer(state).data
+        data['block'] = tip['block_id']
+        data['depth'] = tip['depth']
+        return Response(data)
+
+
+class AccountTransactionsView(APIView):
+    """
+    Returns the transactions sent or received by an account in the longest
+    chain, newest first.
+
+    The number of transactions can be changed with the count parameter, up to
+    ACCOUNT_HISTORY_MAX_PAGE_SIZE. If there are more, the response includes a
+    cursor, which can be passed as the before parameter to get the next page.
+    """
+
+    def get_count(self, request):
+        count = request.GET.get('count')
+        if count and not count.isdigit():
+            raise ValidationError({'count': 'Invalid count.'})
+        count = int(count) if count else settings.ACCOUNT_HISTORY_PAGE_SIZE
+        return max(1, min(count, settings.ACCOUNT_HISTORY_MAX_PAGE_SIZE))
+
+    def get(self, request, key):
+        entries = AccountTransaction.objects.filter(
+            account=key,
+        ).select_related('transaction').order_by('-id')
+
+        before = request.GET.get('before')
+        if before:
+            if not before.isdigit():
+                raise ValidationError({'before': 'Invalid cursor.'})
+            entries = entries.filter(id__lt=int(before))
+
+        count = self.get_count(request)
+        entries = list(entries[:count])
+        cursor = None
+        if len(entries) == count:
+            cursor = str(entries[-1].id)
+
+        return Response({
+            'transactions': TransactionSerializer(
+                [e.transaction for e in entries],
+                many=True,
+            ).data,
+            'cursor': cursor,
+        })
+
+
 class SubmitTransactionView(FormView):
     """
     Accepts a transaction from a sender (wallet) and submits it to the
@@ -15,6 +15,7 @@ echo "Creating genesis block..."
 docker run -v "$PWD:/home/docker/code" -e DB_NAME=db.sqlite3 -e DJANGO_SETTINGS_MODULE=local_settings1 lsapan/boocoin ./manage.py generate_genesis_block $MINERKEYS
 
 echo "Creating test databases..."
+rm -f db1.sqlite3-* db2.sqlite3-* db3.sqlite3-*
 cp db.sqlite3 db1.sqlite3
 cp db.sqlite3 db2.sqlite3
 cp db.sqlite3 db3.sqlite3